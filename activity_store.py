@@ -0,0 +1,255 @@
+import bisect
+import calendar
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from zoneinfo import ZoneInfo
+
+from calendar_store import STATE_DIR, safe_filename
+
+BANGKOK_TZ = ZoneInfo("Asia/Bangkok")
+_MAGIC = b"ACT1"
+_HEADER = struct.Struct("<4sQQ")  # magic, row count, class-names JSON length
+_BANGKOK_OFFSET = 7 * 3600
+
+
+class ActivityRecord:
+    """One tracked activity; start and due are epoch seconds."""
+
+    __slots__ = ("class_id", "activity_id", "start", "due", "title", "class_name")
+
+    def __init__(self, class_id, activity_id, start, due, title, class_name):
+        self.class_id = class_id
+        self.activity_id = activity_id
+        self.start = start
+        self.due = due
+        self.title = title
+        self.class_name = class_name
+
+    @property
+    def key(self):
+        return f"{self.class_id},{self.activity_id}"
+
+    @property
+    def due_bkk(self):
+        return datetime.datetime.fromtimestamp(self.due, BANGKOK_TZ)
+
+
+class _Columns:
+    """Immutable column set, sorted by due date; swapped whole on every update."""
+
+    __slots__ = ("class_id", "activity_id", "start", "due", "title_offsets", "title_blob", "by_class", "_titles", "_mmap")
+
+    def __init__(self, class_id, activity_id, start, due, title_offsets, title_blob, mapped=None):
+        self.class_id = class_id
+        self.activity_id = activity_id
+        self.start = start
+        self.due = due
+        self.title_offsets = title_offsets
+        self.title_blob = title_blob
+        self._titles = {}
+        self._mmap = mapped  # Keeps the mapping alive while the views are in use
+        by_class = {}
+        for row in range(len(class_id)):
+            by_class.setdefault(class_id[row], array("l")).append(row)
+        self.by_class = by_class
+
+    def __len__(self):
+        return len(self.due)
+
+    def title(self, row):
+        title = self._titles.get(row)
+        if title is None:
+            raw = bytes(self.title_blob[self.title_offsets[row]:self.title_offsets[row + 1]])
+            title = self._titles[row] = sys.intern(raw.decode("utf-8"))
+        return title
+
+
+def _epoch(value):
+    """Epoch seconds of a "YYYY-MM-DD HH:MM:SS" Bangkok time (fixed UTC+7, no DST)."""
+    if len(value) != 19 or value[4] != "-" or value[10] != " ":
+        raise ValueError(f"Unexpected date format: {value!r}")
+    fields = (int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19]))
+    return calendar.timegm(fields) - _BANGKOK_OFFSET
+
+
+def _build_columns(rows):
+    """rows: (due, start, class_id, activity_id, UTF-8 title) tuples."""
+    rows.sort()
+    offsets = array("q", [0])
+    blob = bytearray()
+    for row in rows:
+        blob += row[4]
+        offsets.append(len(blob))
+    return _Columns(
+        array("q", (r[2] for r in rows)),
+        array("q", (r[3] for r in rows)),
+        array("q", (r[1] for r in rows)),
+        array("q", (r[0] for r in rows)),
+        offsets,
+        bytes(blob),
+    )
+
+
+class ActivityStore:
+    """Compact, query-able copy of a tenant's current activities.
+
+    Columns (class_id, activity_id, start, due as epoch seconds) are kept in
+    typed arrays sorted by due date, with a per-class row index; titles are
+    one UTF-8 blob decoded and interned on first use. The store is saved to
+    STATE_DIR/activity_index_<name>.bin and memory-mapped on load, so a
+    restart does not parse or copy it. Updates build a new column set and
+    swap it in, so readers never need a lock.
+    """
+
+    def __init__(self, name, state_dir=None):
+        self.path = os.path.join(state_dir or STATE_DIR, f"activity_index_{safe_filename(name or 'default')}.bin")
+        self.class_names = {}
+        self._columns = _build_columns([])
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self):
+        return len(self._columns)
+
+    def _raw_title(self, columns, row):
+        return bytes(columns.title_blob[columns.title_offsets[row]:columns.title_offsets[row + 1]])
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+        try:
+            magic, count, names_length = _HEADER.unpack_from(mapped, 0)
+            if magic != _MAGIC:
+                raise ValueError("bad magic")
+            view = memoryview(mapped)
+            offset = _HEADER.size
+            columns = []
+            for _ in range(4):
+                columns.append(view[offset:offset + 8 * count].cast("q"))
+                offset += 8 * count
+            title_offsets = view[offset:offset + 8 * (count + 1)].cast("q")
+            offset += 8 * (count + 1)
+            title_blob = view[offset:offset + title_offsets[count]]
+            offset += title_offsets[count]
+            names = json.loads(bytes(view[offset:offset + names_length]).decode("utf-8"))
+        except (ValueError, struct.error, IndexError, TypeError) as e:
+            print(f"⚠️ Could not load activity index {self.path}, starting empty: {e}")
+            return
+        self.class_names = {int(k): v for k, v in names.items()}
+        self._columns = _Columns(*columns, title_offsets, title_blob, mapped=mapped)
+
+    def save(self):
+        columns = self._columns
+        names = json.dumps(self.class_names).encode("utf-8")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(columns), len(names)))
+            for column in (columns.class_id, columns.activity_id, columns.start, columns.due, columns.title_offsets):
+                f.write(column.tobytes() if isinstance(column, array) else bytes(column))
+            f.write(bytes(columns.title_blob))
+            f.write(names)
+        os.replace(tmp_path, self.path)
+
+    def replace_classes(self, activities_by_class, class_names=None):
+        """Replace the stored activities of every class with a non-empty result.
+
+        Classes whose fetch failed or came back empty keep their previous
+        rows. Activities without both dates or with a non-numeric ID are skipped.
+        Kept titles are copied as raw bytes, and the file is only rewritten
+        when something changed.
+        """
+        with self._lock:
+            current = self._columns
+            replaced = {int(c) for c, activities in activities_by_class.items() if activities}
+            rows = [
+                (current.due[i], current.start[i], current.class_id[i], current.activity_id[i], self._raw_title(current, i))
+                for i in range(len(current))
+                if current.class_id[i] not in replaced
+            ]
+            for class_id, activities in activities_by_class.items():
+                if not activities:
+                    continue
+                for activity in activities:
+                    try:
+                        rows.append((
+                            _epoch(activity["due_date"]),
+                            _epoch(activity["start_date"]),
+                            int(class_id),
+                            int(activity["id"]),
+                            (activity.get("title") or "Untitled").encode("utf-8"),
+                        ))
+                    except (KeyError, TypeError, ValueError):
+                        continue
+            names = dict(self.class_names)
+            if class_names:
+                names.update({int(k): v for k, v in class_names.items()})
+            columns = _build_columns(rows)
+            if names == self.class_names and self._same(current, columns):
+                return len(current)
+            self.class_names = names
+            self._columns = columns
+            self.save()
+        return len(self._columns)
+
+    @staticmethod
+    def _same(old, new):
+        return len(old) == len(new) and all(
+            bytes(getattr(old, name)) == bytes(getattr(new, name))
+            for name in ("due", "start", "class_id", "activity_id", "title_offsets", "title_blob")
+        )
+
+    def _record(self, columns, row):
+        class_id = columns.class_id[row]
+        return ActivityRecord(
+            class_id, columns.activity_id[row], columns.start[row], columns.due[row],
+            columns.title(row), self.class_names.get(class_id, "Unknown Class"),
+        )
+
+    def due_between(self, start, end, class_ids=None):
+        """Activities due in [start, end) (epoch seconds or aware datetimes), earliest first."""
+        if isinstance(start, datetime.datetime):
+            start = start.timestamp()
+        if isinstance(end, datetime.datetime):
+            end = end.timestamp()
+        columns = self._columns
+        low = bisect.bisect_left(columns.due, start)
+        high = bisect.bisect_left(columns.due, end, lo=low)
+        if class_ids is not None:
+            class_ids = set(class_ids)
+            return [self._record(columns, row) for row in range(low, high) if columns.class_id[row] in class_ids]
+        return [self._record(columns, row) for row in range(low, high)]
+
+    def for_class(self, class_id, after=None):
+        """Activities of one class, earliest due first; only those due after `after` if given."""
+        if isinstance(after, datetime.datetime):
+            after = after.timestamp()
+        columns = self._columns
+        rows = columns.by_class.get(int(class_id), ())
+        return [self._record(columns, row) for row in rows if after is None or columns.due[row] > after]
+
+    def classes(self):
+        """{class_id: activity count} for the stored classes."""
+        return {class_id: len(rows) for class_id, rows in self._columns.by_class.items()}
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_activity_store(name):
+    """Process-wide ActivityStore for a tenant name, loaded on first use."""
+    with _stores_lock:
+        store = _stores.get(name)
+        if store is None:
+            store = _stores[name] = ActivityStore(name)
+        return store
@@ -1,15 +1,25 @@
-import requests
+import copy
 import datetime
+import hashlib
+import json
 import os
+import re
+import threading
 import time
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from zoneinfo import ZoneInfo
+# requests and the Google client libraries are imported on first use so
+# importing this module (e.g. from discord-bot.py) stays fast
 from dotenv import load_dotenv
+# Load .env before the local modules, which read their settings (e.g. STATE_DIR) at import
+load_dotenv()
+import metrics
+import resilience
+from activity_store import get_activity_store
+from calendar_store import CALENDAR_HOST, ORPHAN_PROPERTY, STATE_DIR, get_event_store, write_json_atomic, safe_filename
 # from google.oauth2 import service_account
 # from google.oauth2.service_account import Credentials as ServiceAccountCredentials
-load_dotenv()
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
@@ -17,8 +27,106 @@ calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS_PATH")
 Token_Path = os.getenv("GOOGLE_TOKEN_PATH")
 ACCOUNT_TYPE = os.getenv("GOOGLE_ACCOUNT_TYPE", "service_account").lower()
+SYNC_WINDOW_DAYS = int(os.getenv("SYNC_WINDOW_DAYS", "0") or 0)  # 0 = index the whole calendar
+TRACKING_PROPERTY = "tracking_key"  # Private extendedProperty holding "class_id,activity_id"
+TRACKING_KEY_PATTERN = re.compile(r"^\d+,[^,\s]+$")  # "class_id,activity_id"; anything else was not made by the sync
+BANGKOK_TZ = ZoneInfo("Asia/Bangkok")
+BATCH_SIZE = 50  # Google Calendar allows up to 50 requests per batch call
+ORPHAN_MODE = os.getenv("ORPHAN_MODE", "off").lower()  # What to do with events of removed activities: off, tag or delete
+ORPHAN_TITLE_PREFIX = "[Removed] "
+TENANTS_FILE = os.getenv("TENANTS_FILE")  # JSON list of tenants; unset = single tenant from env
+FETCH_MODE = os.getenv("FETCH_MODE", "full").lower()  # "full" or "windowed"
+FETCH_WINDOW_DAYS = int(os.getenv("FETCH_WINDOW_DAYS", "30") or 30)  # windowed: only activities due within the last N days or later
+FETCH_PAGE_SIZE = int(os.getenv("FETCH_PAGE_SIZE", "0") or 0)  # windowed: page size for paginated requests (0 = single request)
+FETCH_MAX_PAGES = max(1, int(os.getenv("FETCH_MAX_PAGES", "50") or 50))  # windowed: never request more pages than this per class
+STREAM_CHUNK_SIZE = 64 * 1024
+SYNC_DEADLINE_SECONDS = float(os.getenv("SYNC_DEADLINE_SECONDS", "0") or 0)  # Stop retrying after this long (0 = no deadline)
+FETCH_CONCURRENCY = max(1, int(os.getenv("FETCH_CONCURRENCY", "4") or 4))  # Parallel class fetches
+FETCH_RATE_PER_SEC = float(os.getenv("FETCH_RATE_PER_SEC", "2") or 2)  # Activities API request budget
 
-def google_calendar_service():
+SYNC_BUDGET_SECONDS = float(os.getenv("SYNC_BUDGET_SECONDS", "0") or 0)  # Warn when a sync takes longer (0 = off)
+CREDENTIAL_REFRESH_MARGIN = 300  # Refresh access tokens this many seconds before expiry
+
+# Process-wide Calendar clients, keyed by token path
+_calendar_clients = {}
+_client_lock = threading.Lock()
+_credentials_lock = threading.Lock()  # One thread loads or refreshes the credentials at a time
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_fetch_pool = None
+_fetch_pool_lock = threading.Lock()
+# Last activities response per (url, student, class) with its ETag/Last-Modified, for conditional requests
+_conditional_cache = {}
+# Serializes syncs writing to the same calendar, so two runs can't both insert a missing event
+_calendar_sync_locks = {}
+_calendar_sync_locks_lock = threading.Lock()
+# Per-tenant activities API token buckets, keyed by tenant name
+_tenant_limiters = {}
+_tenant_limiters_lock = threading.Lock()
+
+
+def get_http_session():
+    """Return the shared keep-alive session used for activities API calls."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=FETCH_CONCURRENCY, pool_maxsize=FETCH_CONCURRENCY)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire() blocks until a request may be sent.
+
+    The rate adapts to the server: each 429 halves it (on_throttled) and each
+    success creeps it back up towards the configured rate (on_success).
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.1):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate) if rate > 0 else min_rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def on_throttled(self):
+        with self._lock:
+            if self.max_rate <= 0:
+                return  # Unlimited by configuration
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def on_success(self):
+        with self._lock:
+            if 0 < self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.1 * self.max_rate)
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _load_credentials():
+    """Load (refreshing or prompting if needed) the user credentials from Token_Path."""
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
     creds = None
     # if ACCOUNT_TYPE == "service_account":
     #     # Fallback to service account
@@ -27,7 +135,7 @@ def google_calendar_service():
     #             GOOGLE_CREDENTIALS, scopes=SCOPES
     #         )
     #         print("✅ Service account credentials loaded from", GOOGLE_CREDENTIALS)
-    #         return build('calendar', 'v3', credentials=creds)
+    #         return creds
     #     except Exception as e:
     #         print("❌ Failed to load service account credentials:", e)
     # else:
@@ -40,7 +148,7 @@ def google_calendar_service():
                 print("🔄 Access token refreshed.")
             if creds and creds.valid:
                 print("✅ Token loaded successfully from user credentials at", Token_Path)
-                return build('calendar', 'v3', credentials=creds)
+                return creds
             else:
                 print("❌ Token is invalid or expired without refresh token.")
         except Exception as e:
@@ -48,42 +156,354 @@ def google_calendar_service():
 
     # Final fallback — prompt user login
     print("🔓 Prompting for manual authentication...")
+    from google_auth_oauthlib.flow import InstalledAppFlow
     flow = InstalledAppFlow.from_client_secrets_file(GOOGLE_CREDENTIALS, SCOPES)
     creds = flow.run_local_server(port=0)
-    with open(Token_Path, 'w') as token:
-        token.write(creds.to_json())
+    _save_token(creds)
     print("✅ Token saved to", Token_Path)
 
-    return build('calendar', 'v3', credentials=creds)
+    return creds
+
+
+def _build_calendar(creds):
+    # static_discovery reads the discovery document bundled with googleapiclient
+    from googleapiclient.discovery import build
+    return build('calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False)
+
+def _save_token(creds):
+    """Write the token via a temp file + rename so other readers never see a partial file."""
+    tmp_path = f"{Token_Path}.tmp"
+    with open(tmp_path, 'w') as token:
+        token.write(creds.to_json())
+    try:
+        os.replace(tmp_path, Token_Path)
+    except OSError:
+        # A file bind-mounted on its own (docker-compose) cannot be renamed over; overwrite it instead
+        with open(Token_Path, 'w') as token:
+            token.write(creds.to_json())
+        os.remove(tmp_path)
+
+def _needs_refresh(creds):
+    """Whether creds expire within CREDENTIAL_REFRESH_MARGIN seconds and can be refreshed."""
+    if not creds.refresh_token:
+        return False
+    expiry = getattr(creds, "expiry", None)
+    # google-auth keeps expiry as a naive UTC datetime
+    expiring = expiry is None or expiry - datetime.datetime.utcnow() < datetime.timedelta(seconds=CREDENTIAL_REFRESH_MARGIN)
+    return not creds.valid or expiring
+
+def _refresh_credentials(creds):
+    from google.auth.transport.requests import Request
+    creds.refresh(Request())
+    try:
+        _save_token(creds)
+    except OSError as e:
+        print(f"⚠️ Could not persist refreshed token to {Token_Path}: {e}")
+    print("🔄 Access token refreshed proactively.")
+
+def _credentials_entry():
+    """Return the cached credentials entry, loading or refreshing it first if needed.
+
+    Loading may prompt for an OAuth login and refreshing calls Google, so both
+    run outside _client_lock. While one thread refreshes, others whose
+    credentials are still valid carry on with them instead of waiting.
+    """
+    with _client_lock:
+        entry = _calendar_clients.get(Token_Path)
+    if entry is not None and not _needs_refresh(entry["creds"]):
+        return entry
+    usable = entry is not None and entry["creds"].valid
+    if not _credentials_lock.acquire(blocking=not usable):
+        return entry
+    try:
+        with _client_lock:
+            entry = _calendar_clients.get(Token_Path)
+        if entry is not None:
+            if not _needs_refresh(entry["creds"]):
+                return entry
+            try:
+                _refresh_credentials(entry["creds"])
+                entry["refreshed"] = time.time()
+                return entry
+            except Exception as e:
+                print(f"❌ Proactive token refresh failed, rebuilding client: {e}")
+        creds = _load_credentials()
+        now = time.time()
+        entry = {"creds": creds, "services": threading.local(), "created": now, "refreshed": now}
+        with _client_lock:
+            _calendar_clients[Token_Path] = entry
+        return entry
+    finally:
+        _credentials_lock.release()
+
+def google_calendar_service():
+    """Return this thread's Calendar service over the process-wide credentials.
+
+    The credentials are loaded once and refreshed before they expire, so
+    repeated calls don't re-read the token file. googleapiclient services
+    are not thread-safe, so each thread builds its own once and reuses it.
+    Used by the sync, the notifier and event-removal-tool alike.
+    """
+    entry = _credentials_entry()
+    services = entry["services"]
+    service = getattr(services, "service", None)
+    if service is None:
+        service = services.service = _build_calendar(entry["creds"])
+    return service
+
+def calendar_client_health():
+    """Return age and credential state of each cached Calendar client."""
+    now = time.time()
+    health = []
+    with _client_lock:
+        for token_path, entry in _calendar_clients.items():
+            creds = entry["creds"]
+            expiry = getattr(creds, "expiry", None)
+            health.append({
+                "token_path": token_path,
+                "age_seconds": round(now - entry["created"], 1),
+                "since_refresh_seconds": round(now - entry["refreshed"], 1),
+                "valid": bool(creds.valid),
+                "expires_in_seconds": round((expiry - datetime.datetime.utcnow()).total_seconds(), 1) if expiry else None,
+            })
+    return health
+
+def _calendar_client_gauges():
+    for client in calendar_client_health():
+        labels = {"token_path": client["token_path"]}
+        yield "calendar_client_age_seconds", labels, client["age_seconds"]
+        yield "calendar_client_since_refresh_seconds", labels, client["since_refresh_seconds"]
+        yield "calendar_client_valid", labels, int(client["valid"])
+        yield "calendar_client_expires_in_seconds", labels, client["expires_in_seconds"]
+
+
+metrics.register_gauges(_calendar_client_gauges)
+metrics.describe("calendar_client_age_seconds", "Seconds since the cached Calendar credentials were loaded.")
+metrics.describe("calendar_client_since_refresh_seconds", "Seconds since the cached Calendar credentials were last refreshed.")
+metrics.describe("calendar_client_valid", "1 if the cached Calendar credentials are currently valid.")
+metrics.describe("calendar_client_expires_in_seconds", "Seconds until the cached Calendar access token expires.")
+
+
+def _execute(request, op, deadline=None):
+    """Execute a Calendar API request with retries, counting every attempt."""
+    def attempt():
+        metrics.api_call("calendar", op)
+        return request.execute()
+    return resilience.call_with_retry(attempt, CALENDAR_HOST, "calendar", deadline)
+
+def find_event_by_key(service, calendar_id, tracking_key):
+    """Find one activity's event in the shared event store, delta-syncing it first.
 
+    For callers without an event index; the sync builds one with build_event_index.
+    """
+    store = get_event_store(calendar_id)
+    with metrics.timed("find_event_by_key"):
+        store.sync(service)
+        with store.lock:
+            events = list(store.events.values())
+    return next((event for event in events if get_tracking_key(event) == tracking_key), None)
 
-def find_event_by_id(service, calendar_id, event_id):
-    now = datetime.datetime.utcnow().isoformat() + 'Z'
-    events_result = service.events().list(calendarId=calendar_id, maxResults=1000, singleEvents=True).execute()
-    events = events_result.get('items', [])
+def get_tracking_key(event):
+    """Return the "class_id,activity_id" tracking key of a calendar event, or None."""
+    private = event.get('extendedProperties', {}).get('private', {})
+    return private.get(TRACKING_PROPERTY) or event.get('description') or None
 
+def build_event_index(service, calendar_id):
+    """Index the calendar's events by tracking key from the shared event store.
+
+    The store is brought up to date with a syncToken delta (a full listing
+    only the first time), so this costs one request when little changed.
+    If SYNC_WINDOW_DAYS is set, only events ending within that many days in
+    the past (or later) are indexed. Indexed events are the store's own
+    dicts; copy before modifying them.
+    """
+    store = get_event_store(calendar_id)
+    window_start = None
+    if SYNC_WINDOW_DAYS > 0:
+        window_start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=SYNC_WINDOW_DAYS)
+
+    index = {}
+    with metrics.timed("calendar_index"):
+        store.sync(service)
+        with store.lock:
+            events = list(store.events.values())
     for event in events:
-        if event.get('description') == event_id:
-            return event
-    return None
+        key = get_tracking_key(event)
+        if not key:
+            continue
+        if window_start is not None:
+            end = event.get('end', {}).get('dateTime')
+            try:
+                if end and datetime.datetime.fromisoformat(end.replace("Z", "+00:00")) < window_start:
+                    continue
+            except ValueError:
+                pass
+        index[key] = event
+
+    print(f"🗂️ Indexed {len(index)} tracked events from calendar {calendar_id}")
+    return index
+
+class CalendarBatchWriter:
+    """Queue Calendar insert/update/delete requests and send them in HTTP batches.
+
+    Requests are flushed in groups of up to BATCH_SIZE. Sub-requests that fail
+    inside a batch are retried individually with backoff. flush() returns a
+    summary with per-item results.
+    """
+
+    def __init__(self, service, calendar_id, batch_size=BATCH_SIZE, deadline=None):
+        self.service = service
+        self.calendar_id = calendar_id
+        self.deadline = deadline
+        self.batch_size = min(batch_size, BATCH_SIZE)
+        self._pending = []
+        self._results = []
+
+    def insert(self, body, label=None, on_success=None):
+        request = self.service.events().insert(calendarId=self.calendar_id, body=body)
+        self._queue("insert", request, label, on_success)
+
+    def update(self, event_id, body, label=None, on_success=None):
+        request = self.service.events().update(calendarId=self.calendar_id, eventId=event_id, body=body)
+        self._queue("update", request, label, on_success)
 
-def add_or_update_event(service, calendar_id, title, start, end, class_id, activity_id):
+    def delete(self, event_id, label=None, on_success=None):
+        request = self.service.events().delete(calendarId=self.calendar_id, eventId=event_id)
+        self._queue("delete", request, label, on_success)
+
+    def _queue(self, kind, request, label, on_success):
+        self._pending.append((kind, request, label, on_success))
+        if len(self._pending) >= self.batch_size:
+            self._send_pending()
+
+    def _record(self, item, response, error):
+        kind, _, label, on_success = item
+        ok = error is None
+        if ok and on_success:
+            on_success(response)
+        self._results.append({"kind": kind, "label": label, "ok": ok, "error": str(error) if error else None})
+
+    def _send_pending(self):
+        items, self._pending = self._pending, []
+        if not items:
+            return
+
+        failed = {}
+        handled = set()
+
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            handled.add(index)
+            if exception is not None:
+                failed[index] = exception
+            else:
+                self._record(items[index], response, None)
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for i, (_, request, _, _) in enumerate(items):
+            batch.add(request, request_id=str(i))
+        try:
+            metrics.api_call("calendar", "batch")
+            with metrics.timed("calendar_write", mode="batch"):
+                resilience.call_with_retry(batch.execute, CALENDAR_HOST, "calendar", self.deadline, max_attempts=1)
+        except Exception as e:
+            # The batch call itself failed; retry every item without a result
+            print(f"⚠️ Batch request failed, retrying individually: {e}")
+            for i in range(len(items)):
+                if i not in handled:
+                    failed[i] = e
+
+        if any(resilience.classify(e)[1] == 429 for e in failed.values()):
+            # Back off once before retrying sub-requests that were rate limited
+            metrics.rate_limited("calendar")
+            time.sleep(resilience.backoff_delay(0))
+
+        for i in sorted(failed):
+            item = items[i]
+            metrics.retried("calendar")
+            try:
+                with metrics.timed("calendar_write", mode="single"):
+                    response = _execute(item[1], item[0], self.deadline)
+                self._record(item, response, None)
+            except Exception as e:
+                print(f"❌ {item[0].capitalize()} failed for {item[2] or 'event'}: {e}")
+                self._record(item, None, e)
+
+    def flush(self):
+        """Send everything still queued and return a result summary."""
+        self._send_pending()
+        results, self._results = self._results, []
+        summary = {"ok": 0, "failed": 0, "items": results}
+        for result in results:
+            summary["ok" if result["ok"] else "failed"] += 1
+        return summary
+
+def _same_time(calendar_value, local_value):
+    """Compare a Calendar dateTime (usually with offset) to a naive Bangkok isoformat string."""
+    if calendar_value == local_value:
+        return True
+    try:
+        a = datetime.datetime.fromisoformat(calendar_value)
+        b = datetime.datetime.fromisoformat(local_value)
+    except (TypeError, ValueError):
+        return False
+    if a.tzinfo is None:
+        a = a.replace(tzinfo=BANGKOK_TZ)
+    if b.tzinfo is None:
+        b = b.replace(tzinfo=BANGKOK_TZ)
+    return a == b
+
+def add_or_update_event(service, calendar_id, title, start, end, class_id, activity_id, event_index=None, writer=None, on_synced=None):
+    """Insert or update the calendar event for one activity.
+
+    With a CalendarBatchWriter the request is queued instead of executed.
+    on_synced() is called once the calendar is known to match the activity.
+    """
     # Extract the event ID from the title
     event_id = f"{class_id},{activity_id}"
 
-    existing_event = find_event_by_id(service, calendar_id, event_id)
+    if event_index is not None:
+        existing_event = event_index.get(event_id)
+    else:
+        existing_event = find_event_by_key(service, calendar_id, event_id)
     # print(existing_event)
 
+    def remember(event):
+        if event_index is not None and event:
+            event_index[event_id] = event
+        # Keep the shared snapshot current so the notifier needn't re-read the calendar
+        get_event_store(calendar_id).apply_written(event)
+        if on_synced:
+            on_synced()
+
     if existing_event:
-        existing_start = existing_event['start']['dateTime']
-        existing_end = existing_event['end']['dateTime']
+        existing_start = existing_event['start'].get('dateTime')
+        existing_end = existing_event['end'].get('dateTime')
+        private = existing_event.get('extendedProperties', {}).get('private', {})
 
-        if existing_start != start or existing_end != end:
+        if (not _same_time(existing_start, start) or not _same_time(existing_end, end)
+                or existing_event.get('summary') != title or ORPHAN_PROPERTY in private):
+            # Work on a copy: the indexed dict is shared with the event store
+            existing_event = copy.deepcopy(existing_event)
+            # An activity that reappeared upstream loses its orphan tag
+            existing_event.get('extendedProperties', {}).get('private', {}).pop(ORPHAN_PROPERTY, None)
+            existing_event['summary'] = title
             existing_event['start']['dateTime'] = start
             existing_event['end']['dateTime'] = end
-            updated_event = service.events().update(calendarId=calendar_id, eventId=existing_event['id'], body=existing_event).execute()
+            existing_event['start']['timeZone'] = 'Asia/Bangkok'
+            existing_event['end']['timeZone'] = 'Asia/Bangkok'
+            if writer is not None:
+                writer.update(existing_event['id'], existing_event, label=title, on_success=remember)
+                print(f"📝 Queued update: {title}")
+                return
+            request = service.events().update(calendarId=calendar_id, eventId=existing_event['id'], body=existing_event)
+            with metrics.timed("calendar_write", mode="single"):
+                updated_event = _execute(request, "update")
+            remember(updated_event)
             print(f"✅ Updated: {title}")
         else:
+            if on_synced:
+                on_synced()
             print(f"✅ Already exists and up-to-date: {title}")
     else:
         event = {
@@ -91,26 +511,80 @@ def add_or_update_event(service, calendar_id, title, start, end, class_id, activ
             'description': event_id,  # Use the event ID for tracking
             'start': {'dateTime': start, 'timeZone': 'Asia/Bangkok'},
             'end': {'dateTime': end, 'timeZone': 'Asia/Bangkok'},
+            'extendedProperties': {'private': {TRACKING_PROPERTY: event_id}},
         }
-        service.events().insert(calendarId=calendar_id, body=event).execute()
+        if writer is not None:
+            writer.insert(event, label=title, on_success=remember)
+            print(f"📝 Queued create: {title}")
+            return
+        request = service.events().insert(calendarId=calendar_id, body=event)
+        with metrics.timed("calendar_write", mode="single"):
+            created_event = _execute(request, "insert")
+        remember(created_event)
         print(f"➕ Created: {title}")
 
+class ActivitySnapshot:
+    """Persisted content hashes of the activities last written to the calendar.
+
+    Keys are "class_id,activity_id" tracking keys; values hash the normalized
+    title, start_date, due_date and class name, so unchanged activities can
+    skip all Calendar work on the next run.
+    """
+
+    def __init__(self, name, state_dir=None):
+        self.path = os.path.join(state_dir or STATE_DIR, f"activities_{safe_filename(name or 'default')}.json")
+        self.hashes = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.hashes = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Could not load activity snapshot {self.path}: {e}")
+
+    @staticmethod
+    def digest(title, start, end, class_name):
+        normalized = json.dumps([title.strip(), start, end, class_name.strip()], ensure_ascii=False)
+        return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+    def is_unchanged(self, key, digest):
+        return self.hashes.get(key) == digest
+
+    def record(self, key, digest):
+        self.hashes[key] = digest
+
+    def forget_missing(self, class_id, seen_keys):
+        """Drop keys of class_id that were not seen in the latest fetch; return them."""
+        prefix = f"{class_id},"
+        removed = [k for k in self.hashes if k.startswith(prefix) and k not in seen_keys]
+        for key in removed:
+            del self.hashes[key]
+        return removed
+
+    def save(self):
+        write_json_atomic(self.path, self.hashes)
+
+def parse_class_info(class_info_str):
+    """Parse "id,name,id,name,..." into {class_id: class_name}."""
+    class_names = {}
+    class_info_parts = class_info_str.split(',')
+    # Process pairs of id and name
+    for i in range(0, len(class_info_parts), 2):
+        if i + 1 < len(class_info_parts):
+            try:
+                class_id = int(class_info_parts[i])
+                class_name = class_info_parts[i + 1]
+                class_names[class_id] = class_name
+            except ValueError:
+                print(f"❌ Invalid class ID format: {class_info_parts[i]}")
+    return class_names
+
 def load_class_info():
     """Load class information from environment variables."""
     class_info_str = os.getenv("CLASS_INFO")
     class_names = {}
 
     if class_info_str:
-        class_info_parts = class_info_str.split(',')
-        # Process pairs of id and name
-        for i in range(0, len(class_info_parts), 2):
-            if i + 1 < len(class_info_parts):
-                try:
-                    class_id = int(class_info_parts[i])
-                    class_name = class_info_parts[i + 1]
-                    class_names[class_id] = class_name
-                except ValueError:
-                    print(f"❌ Invalid class ID format: {class_info_parts[i]}")
+        class_names = parse_class_info(class_info_str)
     else:
         print("❌ CLASS_INFO not found in environment variables")
         exit(1)
@@ -118,13 +592,13 @@ def load_class_info():
     print(f"📋 Loaded {len(class_names)} classes from environment variables")
     return class_names
 
-def get_headers():
-    """Load headers from environment variables."""
+def get_headers(csrf_token=None, cookie=None):
+    """Load headers from environment variables (or the given credentials)."""
     return {
-        "x-csrf-token": os.getenv("CSRF_TOKEN"),
+        "x-csrf-token": csrf_token or os.getenv("CSRF_TOKEN"),
         "x-requested-with": "XMLHttpRequest",
         "accept": "application/json",
-        "cookie": os.getenv("COOKIE")
+        "cookie": cookie or os.getenv("COOKIE")
     }
 
 def get_student_id():
@@ -143,10 +617,7 @@ def get_activities_url():
         exit(1)
     return activities_url
 
-def fetch_activities(class_id, student_id, headers, activities_url):
-    """Fetch activities for a specific class."""
-    print(f"\n📦 Fetching activities for class_id: {class_id}")
-    
+def _activities_params(class_id, student_id, windowed=False):
     params = {
         "class_id": str(class_id),
         "student_id": student_id,
@@ -159,21 +630,249 @@ def fetch_activities(class_id, student_id, headers, activities_url):
         ],
         "includes[]": ["user:sideload", "fileactivities:ids", "questions:ids"]
     }
-        
-    response = requests.get(
-        activities_url,
-        headers=headers,
-        params=params
+    if windowed:
+        # Only the fields process_activities uses; no user/file/question sideloads
+        params["select[]"] = ["activities:id,class_id,title,start_date,due_date"]
+        del params["includes[]"]
+        params["filter_groups[1][filters][0][key]"] = "due_date"
+        params["filter_groups[1][filters][0][operator]"] = "gt"
+        params["filter_groups[1][filters][0][value]"] = _fetch_window_start().strftime("%Y-%m-%d %H:%M:%S")
+    return params
+
+def _fetch_window_start():
+    """Naive Bangkok time, like the API's start_date/due_date, FETCH_WINDOW_DAYS ago."""
+    return datetime.datetime.now(BANGKOK_TZ).replace(tzinfo=None) - datetime.timedelta(days=FETCH_WINDOW_DAYS)
+
+def _get_with_retry(session, activities_url, headers, params, rate_limiter, deadline, stream=False):
+    def request():
+        if rate_limiter:
+            rate_limiter.acquire()
+        metrics.api_call("activities", "get")
+        response = (session or get_http_session()).get(
+            activities_url,
+            headers=headers,
+            params=params,
+            stream=stream
+        )
+        if response.status_code in resilience.RETRYABLE_STATUSES:
+            response.close()
+            raise resilience.RetryableError(
+                f"HTTP {response.status_code}", response.status_code, response.headers.get("Retry-After")
+            )
+        return response
+
+    return resilience.call_with_retry(
+        request, urlparse(activities_url).netloc, "activities", deadline, throttle=rate_limiter
     )
 
-    if response.status_code == 200:
-        return response.json().get("activities", [])
-    else:
-        print(f"❌ Failed to fetch activities: {response.status_code}")
-        return []
+def fetch_activities(class_id, student_id, headers, activities_url, session=None, rate_limiter=None, deadline=None):
+    """Fetch activities for a specific class.
+
+    429/5xx responses and connection errors are retried with backoff (honoring
+    Retry-After) until the attempts or the run deadline run out. If the API
+    sent an ETag or Last-Modified last time, the request is conditional and a
+    304 reuses the previous activities. With
+    FETCH_MODE=windowed the activities are streamed via iter_activities instead.
+    """
+    print(f"\n📦 Fetching activities for class_id: {class_id}")
+
+    with metrics.timed("fetch_activities", class_id=class_id):
+        try:
+            if FETCH_MODE == "windowed":
+                return list(iter_activities(class_id, student_id, headers, activities_url, session, rate_limiter, deadline))
+            params = _activities_params(class_id, student_id)
+            cache_key = (activities_url, student_id, class_id)
+            cached = _conditional_cache.get(cache_key)
+            if cached:
+                headers = dict(headers)
+                if cached["etag"]:
+                    headers["If-None-Match"] = cached["etag"]
+                if cached["last_modified"]:
+                    headers["If-Modified-Since"] = cached["last_modified"]
+            response = _get_with_retry(session, activities_url, headers, params, rate_limiter, deadline)
+        except Exception as e:
+            print(f"❌ Failed to fetch activities for class_id {class_id}: {e}")
+            return []
+
+        if response.status_code == 304 and cached:
+            metrics.inc("activities_not_modified_total")
+            print(f"♻️ Activities for class_id {class_id} not modified")
+            return cached["activities"]
+        if response.status_code == 200:
+            activities = response.json().get("activities", [])
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                # Remember the validators so the next poll can be answered with a 304
+                _conditional_cache[cache_key] = {"etag": etag, "last_modified": last_modified, "activities": activities}
+            return activities
+        else:
+            print(f"❌ Failed to fetch activities: {response.status_code}")
+            return []
+
+def _iter_json_array(chunks, key):
+    """Yield the items of the top-level JSON array `key` from an iterable of text chunks.
+
+    Items are decoded one at a time, so the full response is never held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    chunks = iter(chunks)
+    exhausted = False
+
+    def more():
+        nonlocal buffer, pos, exhausted
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            exhausted = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    # Find the opening bracket of the array
+    marker = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    while True:
+        match = marker.search(buffer)
+        if match:
+            pos = match.end()
+            break
+        if not more():
+            return
+        # Keep only a tail long enough to hold a marker split across chunks
+        pos = max(0, len(buffer) - len(key) - 64)
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buffer):
+            if not more():
+                raise ValueError(f"Unterminated '{key}' array in response")
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if exhausted or not more():
+                raise
+            continue
+        pos = end
+        yield item
+
+def _in_fetch_window(activity, window_start):
+    due_date = activity.get("due_date")
+    if not activity.get("start_date") or not due_date:
+        return False
+    try:
+        return datetime.datetime.strptime(due_date, "%Y-%m-%d %H:%M:%S") >= window_start
+    except ValueError:
+        return False
+
+def _has_next_page(response, page):
+    """Whether another page follows according to the response's pagination headers, or None without any."""
+    if response.headers.get("Link"):
+        return "next" in response.links
+    for header, pages in (("X-Total-Pages", 1), ("X-Total-Count", FETCH_PAGE_SIZE)):
+        try:
+            return page * pages < int(response.headers[header])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+def iter_activities(class_id, student_id, headers, activities_url, session=None, rate_limiter=None, deadline=None):
+    """Stream a class's activities due within FETCH_WINDOW_DAYS, parsing incrementally.
+
+    The due-date window is sent as a server-side filter and re-checked locally.
+    With FETCH_PAGE_SIZE set, pages are requested while the pagination headers
+    (Link, X-Total-Pages or X-Total-Count) say more follow, or without them
+    until one comes back short. An API that ignores the page parameters
+    returns the same activities again, so paging also stops at a page with no
+    new IDs, and after FETCH_MAX_PAGES.
+    """
+    params = _activities_params(class_id, student_id, windowed=True)
+    window_start = _fetch_window_start()
+    seen = set()
+    page = 1
+    while True:
+        if FETCH_PAGE_SIZE > 0:
+            params["limit"] = FETCH_PAGE_SIZE
+            params["page"] = page
+        response = _get_with_retry(session, activities_url, headers, params, rate_limiter, deadline, stream=True)
+        count = 0
+        new = 0
+        try:
+            if response.status_code != 200:
+                print(f"❌ Failed to fetch activities: {response.status_code}")
+                return
+            response.encoding = response.encoding or "utf-8"
+            for activity in _iter_json_array(response.iter_content(STREAM_CHUNK_SIZE, decode_unicode=True), "activities"):
+                count += 1
+                activity_id = activity.get("id")
+                if activity_id is not None:
+                    if activity_id in seen:
+                        continue
+                    seen.add(activity_id)
+                new += 1
+                if _in_fetch_window(activity, window_start):
+                    yield activity
+        finally:
+            response.close()
+        if FETCH_PAGE_SIZE <= 0:
+            return
+        has_next = _has_next_page(response, page)
+        if has_next is False or (has_next is None and count < FETCH_PAGE_SIZE):
+            return
+        if new == 0:
+            print(f"⚠️ Page {page} of class {class_id} only repeated earlier activities, stopping pagination")
+            return
+        if page >= FETCH_MAX_PAGES:
+            print(f"⚠️ Stopped paginating class {class_id} after FETCH_MAX_PAGES={FETCH_MAX_PAGES} pages")
+            return
+        page += 1
+
+def _get_fetch_pool():
+    global _fetch_pool
+    with _fetch_pool_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="fetch")
+        return _fetch_pool
+
+def fetch_all_activities(class_ids, student_id, headers, activities_url, deadline=None, rate_limiter=None):
+    """Fetch activities for every class concurrently.
+
+    Uses the process-wide pool of FETCH_CONCURRENCY workers sharing one
+    keep-alive session (so concurrent tenants share the same connections),
+    paced by rate_limiter or a new FETCH_RATE_PER_SEC token bucket.
+    Returns {class_id: activities} in the order of class_ids.
+    """
+    session = get_http_session()
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(FETCH_RATE_PER_SEC)
+
+    def fetch(class_id):
+        try:
+            return fetch_activities(class_id, student_id, headers, activities_url, session, rate_limiter, deadline)
+        except Exception as e:
+            print(f"❌ Failed to fetch activities for class_id {class_id}: {e}")
+            return []
 
-def process_activities(activities, class_id, class_name, calendar_service, calendar_id):
-    """Process activities and add/update calendar events."""
+    results = list(_get_fetch_pool().map(fetch, class_ids))
+    return dict(zip(class_ids, results))
+
+def process_activities(activities, class_id, class_name, calendar_service, calendar_id, event_index=None, writer=None, snapshot=None):
+    """Process activities and add/update calendar events.
+
+    When event_index (see build_event_index) is given, existing events are looked
+    up in it instead of listing the calendar for every activity. When writer is
+    given, calendar writes are queued on it and sent in batches. When snapshot
+    (an ActivitySnapshot) is given, activities unchanged since the last run are
+    skipped.
+    """
+    seen_keys = set()
+    skipped = 0
     for activity in activities:
         title = activity.get("title", "Untitled")
         activity_id = activity.get("id", "Unknown ID")
@@ -186,25 +885,234 @@ def process_activities(activities, class_id, class_name, calendar_service, calen
             start = datetime.datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S").isoformat()
             end = datetime.datetime.strptime(due_date, "%Y-%m-%d %H:%M:%S").isoformat()
 
-            add_or_update_event(calendar_service, calendar_id, title, start, end, class_id, activity_id)
+            if event_index is not None and SYNC_WINDOW_DAYS > 0:
+                window_start = datetime.datetime.now() - datetime.timedelta(days=SYNC_WINDOW_DAYS)
+                if datetime.datetime.fromisoformat(end) < window_start:
+                    # Outside the indexed window; we can't tell if it already exists
+                    continue
+
+            key = f"{class_id},{activity_id}"
+            seen_keys.add(key)
+            on_synced = None
+            if snapshot is not None:
+                digest = snapshot.digest(title, start, end, class_name)
+                # Skip unchanged activities, unless their calendar event has gone missing
+                if snapshot.is_unchanged(key, digest) and (event_index is None or key in event_index):
+                    skipped += 1
+                    continue
+                on_synced = lambda key=key, digest=digest: snapshot.record(key, digest)
+
+            add_or_update_event(calendar_service, calendar_id, title, start, end, class_id, activity_id, event_index, writer, on_synced)
+
+    if snapshot is not None:
+        if skipped:
+            print(f"⏭️ Skipped {skipped} unchanged activities for {class_name}")
+        if activities:
+            removed = snapshot.forget_missing(class_id, seen_keys)
+            if removed:
+                print(f"🗑️ {len(removed)} activities no longer listed for {class_name}: {', '.join(removed)}")
+
+class Tenant:
+    """One student's activities API credentials, classes and target calendar/channel."""
+
+    def __init__(self, name, student_id, headers, class_names, activities_url, calendar_id, channel_id=None, rate_per_sec=None):
+        self.name = name
+        self.student_id = student_id
+        self.headers = headers
+        self.class_names = class_names
+        self.activities_url = activities_url
+        self.calendar_id = calendar_id
+        self.channel_id = channel_id
+        self.rate_per_sec = FETCH_RATE_PER_SEC if rate_per_sec is None else rate_per_sec
+
+def tenant_from_env():
+    """The single tenant described by the environment variables."""
+    return Tenant(
+        name=calendar_id,
+        student_id=get_student_id(),
+        headers=get_headers(),
+        class_names=load_class_info(),
+        activities_url=get_activities_url(),
+        calendar_id=calendar_id,
+    )
+
+def load_tenants(path=None):
+    """Load tenants from the TENANTS_FILE JSON list, or the env tenant if none is set.
+
+    Each entry needs name, student_id, cookie, csrf_token, class_info ("id,name,..."
+    string or {id: name} object) and calendar_id; activities_url, channel_id and
+    rate_per_sec are optional.
+    """
+    path = path or TENANTS_FILE
+    if not path:
+        return [tenant_from_env()]
+
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+
+    tenants = []
+    for entry in entries:
+        try:
+            class_info = entry["class_info"]
+            if isinstance(class_info, dict):
+                class_names = {int(k): v for k, v in class_info.items()}
+            else:
+                class_names = parse_class_info(class_info)
+            csrf_token, cookie = entry["csrf_token"], entry["cookie"]
+            if not csrf_token or not cookie:
+                # get_headers would fall back to the env credentials, i.e. another student's session
+                raise ValueError("csrf_token and cookie must not be empty")
+            channel_id = entry.get("channel_id")
+            tenants.append(Tenant(
+                name=entry["name"],
+                student_id=str(entry["student_id"]),
+                headers=get_headers(csrf_token, cookie),
+                class_names=class_names,
+                activities_url=entry.get("activities_url") or get_activities_url(),
+                calendar_id=entry["calendar_id"],
+                channel_id=int(channel_id) if channel_id else None,
+                rate_per_sec=entry.get("rate_per_sec"),
+            ))
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"❌ Skipping invalid tenant entry {entry.get('name', '?') if isinstance(entry, dict) else entry}: {e}")
+    print(f"👥 Loaded {len(tenants)} tenant(s) from {path}")
+    return tenants
+
+def _tenant_rate_limiter(tenant):
+    # Kept across runs so the adaptive rate remembers earlier 429s
+    with _tenant_limiters_lock:
+        limiter = _tenant_limiters.get(tenant.name)
+        if limiter is None:
+            limiter = _tenant_limiters[tenant.name] = TokenBucket(tenant.rate_per_sec)
+        return limiter
 
 def get_activities():
-    # Load data from environment variables
-    headers = get_headers()
-    class_names = load_class_info()
-    class_ids = list(class_names.keys())
-    student_id = get_student_id()
-    activities_url = get_activities_url()
-    
+    """Sync the single tenant configured through the environment variables."""
+    return sync_tenant(tenant_from_env())
+
+def sync_tenant(tenant):
+    """Fetch one tenant's activities and sync them into its calendar."""
+    with _calendar_sync_locks_lock:
+        lock = _calendar_sync_locks.setdefault(tenant.calendar_id, threading.Lock())
+    with lock, metrics.timed("sync_run", budget=SYNC_BUDGET_SECONDS or None, tenant=tenant.name):
+        return _sync_tenant(tenant)
+
+def _sync_tenant(tenant):
+    class_ids = list(tenant.class_names.keys())
+
     # Initialize Google Calendar service
     calendar_service = google_calendar_service()
+    event_index = build_event_index(calendar_service, tenant.calendar_id)
+    deadline = resilience.Deadline(SYNC_DEADLINE_SECONDS)
+    writer = CalendarBatchWriter(calendar_service, tenant.calendar_id, deadline=deadline)
+    snapshot = ActivitySnapshot(tenant.name)
 
-    # Process each class
+    # Fetch every class up front, then process them in order
+    activities_by_class = fetch_all_activities(
+        class_ids, tenant.student_id, tenant.headers, tenant.activities_url, deadline, _tenant_rate_limiter(tenant)
+    )
     for class_id in class_ids:
-        activities = fetch_activities(class_id, student_id, headers, activities_url)
-        class_name = class_names.get(class_id, "Unknown Class")
-        process_activities(activities, class_id, class_name, calendar_service, calendar_id)
-        time.sleep(5)
+        activities = activities_by_class[class_id]
+        class_name = tenant.class_names.get(class_id, "Unknown Class")
+        process_activities(activities, class_id, class_name, calendar_service, tenant.calendar_id, event_index, writer, snapshot)
+
+    # Keep the queryable activity index in step with what was fetched
+    get_activity_store(tenant.name).replace_classes(activities_by_class, tenant.class_names)
+
+    known_keys, covered = upstream_keys(tenant, activities_by_class)
+    reconcile_orphans(event_index, known_keys, covered, writer)
+
+    summary = writer.flush()
+    snapshot.save()
+    get_event_store(tenant.calendar_id).save()
+    print(f"📤 Calendar writes for {tenant.name}: {summary['ok']} succeeded, {summary['failed']} failed")
+    return summary
+
+def tenant_for_calendar(calendar_id):
+    """The configured tenant syncing into calendar_id, or None."""
+    for tenant in load_tenants():
+        if tenant.calendar_id == calendar_id:
+            return tenant
+    return None
+
+def upstream_keys(tenant, activities_by_class=None, deadline=None):
+    """Return (tracking keys of the tenant's current activities, class IDs they cover).
+
+    Classes whose fetch failed or came back empty are left out of the covered
+    set, so their events are never mistaken for orphans.
+    """
+    if activities_by_class is None:
+        activities_by_class = fetch_all_activities(
+            list(tenant.class_names), tenant.student_id, tenant.headers, tenant.activities_url,
+            deadline, _tenant_rate_limiter(tenant)
+        )
+    keys = set()
+    covered = set()
+    for class_id, activities in activities_by_class.items():
+        if not activities:
+            continue
+        covered.add(int(class_id))
+        keys.update(f"{class_id},{a.get('id')}" for a in activities)
+    return keys, covered
+
+def is_orphan(event, known_keys, covered_class_ids):
+    """True if event was created by this sync for an activity that no longer exists upstream."""
+    key = get_tracking_key(event)
+    if not key or key in known_keys or not TRACKING_KEY_PATTERN.match(key):
+        return False
+    try:
+        class_id = int(key.split(",", 1)[0])
+    except ValueError:
+        return False
+    if class_id not in covered_class_ids:
+        return False
+    if FETCH_MODE == "windowed":
+        # Activities due before the fetch window were never fetched, so absence proves nothing
+        end = event.get("end", {}).get("dateTime")
+        try:
+            end_local = datetime.datetime.fromisoformat(end).astimezone(BANGKOK_TZ).replace(tzinfo=None)
+        except (TypeError, ValueError):
+            return False
+        if end_local < _fetch_window_start():
+            return False
+    return True
+
+def reconcile_orphans(event_index, known_keys, covered_class_ids, writer):
+    """Delete or tag (per ORPHAN_MODE) indexed events whose activity is gone upstream.
+
+    Requests are queued on writer; returns the number of orphans found.
+    """
+    if ORPHAN_MODE not in ("delete", "tag"):
+        return 0
+
+    orphans = 0
+    store = get_event_store(writer.calendar_id)
+    with metrics.timed("reconcile_orphans"):
+        for key, event in list(event_index.items()):
+            if not is_orphan(event, known_keys, covered_class_ids):
+                continue
+            title = event.get('summary', 'Untitled')
+            if ORPHAN_MODE == "delete":
+                def forget(_, key=key, event_id=event['id']):
+                    event_index.pop(key, None)
+                    store.forget(event_id)
+                writer.delete(event['id'], label=title, on_success=forget)
+                print(f"🗑️ Queued delete of orphaned event: {title}")
+            else:
+                if event.get('extendedProperties', {}).get('private', {}).get(ORPHAN_PROPERTY):
+                    continue
+                event = copy.deepcopy(event)
+                event.setdefault('extendedProperties', {}).setdefault('private', {})[ORPHAN_PROPERTY] = "true"
+                event['summary'] = ORPHAN_TITLE_PREFIX + title
+                writer.update(event['id'], event, label=title, on_success=store.apply_written)
+                print(f"🏷️ Queued orphan tag: {title}")
+            orphans += 1
+
+    if orphans:
+        metrics.inc("orphans_total", orphans, mode=ORPHAN_MODE)
+    print(f"🧹 Found {orphans} orphaned events")
+    return orphans
 
 if __name__ == "__main__":
-    get_activities()
+    for tenant in load_tenants():
+        sync_tenant(tenant)
@@ -0,0 +1,323 @@
+"""Local stand-ins for the activities API, Google Calendar v3 and Discord.
+
+Each fake counts the calls it receives and can inject latency and 429
+responses, so sync/notify runs can be measured without live services.
+"""
+import datetime
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+class CallCounter:
+    """Thread-safe named counters."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+def make_activities(class_id, count, start_id=1, now=None):
+    """Build `count` activity dicts shaped like the activities API response."""
+    now = now or datetime.datetime.now()
+    activities = []
+    for i in range(count):
+        start = now - datetime.timedelta(days=7) + datetime.timedelta(hours=i)
+        due = start + datetime.timedelta(days=14)
+        activities.append({
+            "id": start_id + i,
+            "class_id": class_id,
+            "title": f"Activity {start_id + i}",
+            "start_date": start.strftime("%Y-%m-%d %H:%M:%S"),
+            "due_date": due.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+    return activities
+
+
+# Activities API
+
+class FakeActivitiesServer:
+    """HTTP server answering activities requests from an in-memory {class_id: [activity]} map."""
+
+    def __init__(self, activities_by_class, latency=0.0, error_rate=0.0, seed=0, etags=True):
+        self.activities_by_class = activities_by_class
+        self.etags = etags  # Send ETags and answer matching If-None-Match with 304
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = CallCounter()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/activities"
+
+    def _should_fail(self):
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.calls.add("activities.get")
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake._should_fail():
+                    fake.calls.add("activities.429")
+                    self.send_response(429)
+                    self.send_header("Retry-After", "1")
+                    self.end_headers()
+                    return
+                query = parse_qs(urlparse(self.path).query)
+                class_id = int(query.get("class_id", ["0"])[0])
+                body = json.dumps({"activities": fake.activities_by_class.get(class_id, [])}).encode("utf-8")
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if fake.etags and self.headers.get("If-None-Match") == etag:
+                    fake.calls.add("activities.304")
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                if fake.etags:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Google Calendar v3
+
+def _http_error(status):
+    resp = httplib2.Response({"status": status})
+    resp.reason = "Too Many Requests" if status == 429 else "Error"
+    return HttpError(resp, b"{}")
+
+
+class FakeRequest:
+    """Mimics googleapiclient's HttpRequest: execute() runs the operation."""
+
+    def __init__(self, calendar, name, operation):
+        self.calendar = calendar
+        self.name = name
+        self.operation = operation
+
+    def run(self):
+        self.calendar.calls.add(f"events.{self.name}")
+        if self.calendar.should_fail():
+            self.calendar.calls.add("calendar.429")
+            raise _http_error(429)
+        return self.operation()
+
+    def execute(self, **kwargs):
+        self.calendar.calls.add("calendar.http")
+        if self.calendar.latency:
+            time.sleep(self.calendar.latency)
+        return self.run()
+
+
+class FakeBatch:
+    def __init__(self, calendar, callback):
+        self.calendar = calendar
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback))
+
+    def execute(self, **kwargs):
+        self.calendar.calls.add("calendar.http")
+        self.calendar.calls.add("batch")
+        if self.calendar.latency:
+            time.sleep(self.calendar.latency)
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.run(), None
+            except HttpError as e:
+                response, exception = None, e
+            (callback or self.callback)(request_id, response, exception)
+
+
+class FakeEvents:
+    def __init__(self, calendar):
+        self.calendar = calendar
+
+    def list(self, calendarId=None, pageToken=None, maxResults=250, syncToken=None, timeMin=None, **kwargs):
+        return FakeRequest(self.calendar, "list", lambda: self.calendar.list_page(pageToken, maxResults, syncToken, timeMin))
+
+    def insert(self, calendarId=None, body=None, **kwargs):
+        return FakeRequest(self.calendar, "insert", lambda: self.calendar.put(None, body))
+
+    def update(self, calendarId=None, eventId=None, body=None, **kwargs):
+        return FakeRequest(self.calendar, "update", lambda: self.calendar.put(eventId, body))
+
+    def delete(self, calendarId=None, eventId=None, **kwargs):
+        return FakeRequest(self.calendar, "delete", lambda: self.calendar.remove(eventId))
+
+
+class FakeCalendarService:
+    """In-memory Calendar v3 service supporting paging, syncTokens and batches."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = CallCounter()
+        self.events_by_id = {}
+        self._changes = []  # Event IDs in modification order; sync tokens index into it
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def events(self):
+        return FakeEvents(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def seed_events(self, events):
+        for body in events:
+            self.put(None, body)
+
+    def put(self, event_id, body):
+        with self._lock:
+            event = dict(body)
+            event["id"] = event_id or f"evt{next(self._ids)}"
+            event["status"] = "confirmed"
+            event["updated"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            self.events_by_id[event["id"]] = event
+            self._changes.append(event["id"])
+            return event
+
+    def remove(self, event_id):
+        with self._lock:
+            if event_id not in self.events_by_id:
+                raise _http_error(404)
+            self.events_by_id[event_id]["status"] = "cancelled"
+            self._changes.append(event_id)
+            return ""
+
+    def list_page(self, page_token, max_results, sync_token, time_min):
+        with self._lock:
+            if sync_token is not None:
+                seen = set()
+                ids = [i for i in self._changes[int(sync_token):] if not (i in seen or seen.add(i))]
+                items = [self.events_by_id[i] for i in ids]
+            else:
+                items = [e for e in self.events_by_id.values() if e["status"] != "cancelled"]
+                if time_min:
+                    items = [e for e in items if e.get("end", {}).get("dateTime", "") >= time_min[:19]]
+            offset = int(page_token or 0)
+            max_results = max_results or 250
+            page = items[offset:offset + max_results]
+            response = {"items": [dict(e) for e in page]}
+            if offset + max_results < len(items):
+                response["nextPageToken"] = str(offset + max_results)
+            else:
+                response["nextSyncToken"] = str(len(self._changes))
+            return response
+
+
+def make_calendar_event(class_id, activity_id, start, end, title=None):
+    key = f"{class_id},{activity_id}"
+    return {
+        "summary": title or f"Class {class_id} - Activity {activity_id}",
+        "description": key,
+        "start": {"dateTime": start, "timeZone": "Asia/Bangkok"},
+        "end": {"dateTime": end, "timeZone": "Asia/Bangkok"},
+        "extendedProperties": {"private": {"tracking_key": key}},
+    }
+
+
+# Discord
+
+class FakeMessage:
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel._call("edit")
+        self.channel.messages[self.id] = content
+
+    async def delete(self):
+        await self.channel._call("delete")
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeChannel:
+    """Discord text channel stand-in recording sends, edits and deletes."""
+
+    def __init__(self, channel_id=1, name="bench", latency=0.0):
+        self.id = channel_id
+        self.name = name
+        self.latency = latency
+        self.calls = CallCounter()
+        self.messages = {}
+        self._ids = itertools.count(1)
+
+    async def _call(self, name):
+        self.calls.add(f"discord.{name}")
+        if self.latency:
+            import asyncio
+            await asyncio.sleep(self.latency)
+
+    async def send(self, content=None, **kwargs):
+        await self._call("send")
+        message = FakeMessage(self, next(self._ids))
+        self.messages[message.id] = content
+        return message
+
+    async def fetch_message(self, message_id):
+        await self._call("fetch_message")
+        return FakeMessage(self, message_id)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self, message_id)
+
+    async def delete_messages(self, messages):
+        await self._call("bulk_delete")
+        for message in messages:
+            self.messages.pop(message.id, None)
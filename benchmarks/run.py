@@ -0,0 +1,247 @@
+"""Offline benchmarks for the sync and notify paths.
+
+Runs get_activities, _process_calendar, clear_calendar and the two chained
+(pipeline: a sync followed by a notify over the shared event store) against
+the local stand-ins in fakes.py and prints one JSON result per scenario and scale:
+wall time, peak traced memory and API-call counts.
+
+    python benchmarks/run.py --scales 10,100,10000 --latency-ms 5 --error-rate 0.01 --output bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_CALENDAR_ID = "bench-calendar"
+BENCH_CHANNEL_ID = 1
+ACTIVITIES_PER_CLASS = 100
+
+# Must be set before the bot modules are imported: they read these at import time
+STATE_DIR = tempfile.mkdtemp(prefix="bench-state-")
+os.environ.update({
+    "STATE_DIR": STATE_DIR,
+    "GOOGLE_CALENDAR_ID": BENCH_CALENDAR_ID,
+    "CALENDAR_MAP": f"{BENCH_CALENDAR_ID}:{BENCH_CHANNEL_ID}",
+    "DISCORD_TOKEN": "",
+    "FETCH_RATE_PER_SEC": "0",
+    "STUDENT_ID": "1",
+    "CSRF_TOKEN": "bench",
+    "COOKIE": "bench",
+})
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import activity_store  # noqa: E402
+import calendar_store  # noqa: E402
+import fakes  # noqa: E402
+
+
+def _load_script(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _reset_state():
+    for entry in os.listdir(STATE_DIR):
+        os.remove(os.path.join(STATE_DIR, entry))
+    calendar_store._stores.clear()
+    activity_store._stores.clear()
+
+
+def _measure(scenario, scale, func, counters, quiet=True):
+    for counter in counters:
+        counter.reset()
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+            func()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = {}
+    for counter in counters:
+        calls.update(counter.snapshot())
+    return {
+        "scenario": scenario,
+        "scale": scale,
+        "wall_seconds": round(wall, 4),
+        "peak_memory_bytes": peak,
+        "api_calls": calls,
+        "error": error,
+    }
+
+
+def _split_classes(scale):
+    classes = max(1, (scale + ACTIVITIES_PER_CLASS - 1) // ACTIVITIES_PER_CLASS)
+    activities_by_class = {}
+    remaining = scale
+    next_id = 1
+    for class_id in range(1, classes + 1):
+        count = min(ACTIVITIES_PER_CLASS, remaining)
+        activities_by_class[class_id] = fakes.make_activities(class_id, count, start_id=next_id)
+        next_id += count
+        remaining -= count
+    return activities_by_class
+
+
+def bench_get_activities(api_bot, scale, args):
+    activities_by_class = _split_classes(scale)
+    os.environ["CLASS_INFO"] = ",".join(f"{c},Class{c}" for c in activities_by_class)
+    calendar = fakes.FakeCalendarService(latency=args.latency, error_rate=args.error_rate)
+    api_bot.google_calendar_service = lambda: calendar
+
+    results = []
+    _reset_state()
+    with fakes.FakeActivitiesServer(activities_by_class, latency=args.latency, error_rate=args.error_rate) as server:
+        os.environ["ACTIVITIES_URL"] = server.url
+        counters = [server.calls, calendar.calls]
+        # Cold run fills an empty calendar; warm run repeats with nothing changed
+        results.append(_measure("get_activities.cold", scale, api_bot.get_activities, counters, args.quiet))
+        results.append(_measure("get_activities.warm", scale, api_bot.get_activities, counters, args.quiet))
+    return results
+
+
+def _prepare_bot(bot, calendar, channel):
+    bot._PREV_MESSAGE_IDS.clear()
+    bot._PREV_CHUNK_HASHES.clear()
+    bot._RENDERED_VERSIONS.clear()
+    bot.google_calendar_service = lambda: calendar
+
+    async def resolve_channel(channel_id):
+        return channel
+
+    bot._resolve_channel = resolve_channel
+    # Per-channel budgets are created lazily; give the benchmark channel an unlimited one
+    bot._CHANNEL_BUDGETS[BENCH_CHANNEL_ID] = bot.ChannelBudget(rate=10 ** 9, period=1.0)
+
+
+def bench_process_calendar(bot, scale, args):
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    calendar = fakes.FakeCalendarService(latency=args.latency, error_rate=args.error_rate)
+    calendar.seed_events(
+        fakes.make_calendar_event(
+            1, i,
+            (now + datetime.timedelta(hours=i)).isoformat(),
+            (now + datetime.timedelta(days=1, hours=i)).isoformat(),
+        )
+        for i in range(scale)
+    )
+    channel = fakes.FakeChannel(BENCH_CHANNEL_ID, latency=args.latency)
+
+    _reset_state()
+    _prepare_bot(bot, calendar, channel)
+    # Measure the Calendar delta sync on every run rather than the freshness shortcut
+    bot.CALENDAR_FRESH_SECONDS = 0
+
+    def run():
+        run_now = datetime.datetime.now(datetime.timezone.utc)
+        asyncio.run(bot._process_calendar(BENCH_CALENDAR_ID, BENCH_CHANNEL_ID, run_now, run_now.astimezone(bot.BANGKOK_TZ)))
+
+    counters = [calendar.calls, channel.calls]
+    return [
+        _measure("process_calendar.cold", scale, run, counters, args.quiet),
+        _measure("process_calendar.warm", scale, run, counters, args.quiet),
+    ]
+
+
+def bench_clear_calendar(removal_tool, scale, args):
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    calendar = fakes.FakeCalendarService(latency=args.latency, error_rate=args.error_rate)
+    calendar.seed_events(
+        fakes.make_calendar_event(1, i, now.isoformat(), (now + datetime.timedelta(hours=1)).isoformat())
+        for i in range(scale)
+    )
+    removal_tool.google_calendar_service = lambda: calendar
+    return [_measure("clear_calendar", scale, lambda: removal_tool.clear_calendar(BENCH_CALENDAR_ID), [calendar.calls], args.quiet)]
+
+
+def bench_pipeline(api_bot, bot, scale, args):
+    activities_by_class = _split_classes(scale)
+    os.environ["CLASS_INFO"] = ",".join(f"{c},Class{c}" for c in activities_by_class)
+    calendar = fakes.FakeCalendarService(latency=args.latency, error_rate=args.error_rate)
+    channel = fakes.FakeChannel(BENCH_CHANNEL_ID, latency=args.latency)
+    api_bot.google_calendar_service = lambda: calendar
+
+    _reset_state()
+    _prepare_bot(bot, calendar, channel)
+    bot.CALENDAR_FRESH_SECONDS = 60
+
+    def notify():
+        run_now = datetime.datetime.now(datetime.timezone.utc)
+        asyncio.run(bot._process_calendar(BENCH_CALENDAR_ID, BENCH_CHANNEL_ID, run_now, run_now.astimezone(bot.BANGKOK_TZ)))
+
+    with fakes.FakeActivitiesServer(activities_by_class, latency=args.latency, error_rate=args.error_rate) as server:
+        os.environ["ACTIVITIES_URL"] = server.url
+        counters = [server.calls, calendar.calls, channel.calls]
+        return [
+            _measure("pipeline.sync", scale, api_bot.get_activities, counters, args.quiet),
+            # Reads the events the sync just wrote from the shared store: no Calendar calls
+            _measure("pipeline.notify", scale, notify, counters, args.quiet),
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10,100,10000", help="Comma-separated activity/event counts")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latency added to every fake API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake API calls answered with 429")
+    parser.add_argument("--scenarios", default="get_activities,process_calendar,clear_calendar,pipeline")
+    parser.add_argument("--output", help="Write results as JSON to this file instead of stdout")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="Show the bot's own log output")
+    args = parser.parse_args()
+    args.latency = args.latency_ms / 1000.0
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        api_bot = _load_script("api_bot", "api_bot.py")
+        bot = _load_script("discord_bot", "discord-bot.py")
+        removal_tool = _load_script("event_removal_tool", "event-removal-tool.py")
+
+    benches = {
+        "get_activities": lambda scale: bench_get_activities(api_bot, scale, args),
+        "process_calendar": lambda scale: bench_process_calendar(bot, scale, args),
+        "clear_calendar": lambda scale: bench_clear_calendar(removal_tool, scale, args),
+        "pipeline": lambda scale: bench_pipeline(api_bot, bot, scale, args),
+    }
+
+    results = []
+    try:
+        for scale in (int(s) for s in args.scales.split(",") if s.strip()):
+            for name in (s.strip() for s in args.scenarios.split(",") if s.strip()):
+                for result in benches[name](scale):
+                    result["latency_ms"] = args.latency_ms
+                    result["error_rate"] = args.error_rate
+                    results.append(result)
+                    print(f"{result['scenario']:<24} n={scale:<6} {result['wall_seconds']:>9.3f}s  "
+                          f"peak={result['peak_memory_bytes'] / 1024:>9.0f} KiB  calls={sum(result['api_calls'].values())}",
+                          file=sys.stderr)
+    finally:
+        shutil.rmtree(STATE_DIR, ignore_errors=True)
+
+    report = json.dumps({"results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import metrics
+import resilience
+
+# Directory for locally persisted bot state (mount it as a volume in Docker)
+STATE_DIR = os.getenv("STATE_DIR", "state")
+ORPHAN_PROPERTY = "orphaned"  # Private property set on events whose activity was removed upstream
+CALENDAR_HOST = "www.googleapis.com"  # Circuit breaker key for Calendar API calls
+
+
+def safe_filename(name):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+
+def write_json_atomic(path, data):
+    """Write JSON to path via a temp file + rename so readers never see partial files."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CalendarEventStore:
+    """Local copy of one calendar's events kept current with Calendar syncTokens.
+
+    The first sync lists the whole calendar; later syncs only request deltas
+    with the stored nextSyncToken. A 410 Gone response (expired token) falls
+    back to a full resync. Events are kept as raw Calendar API dicts.
+
+    Writers apply the events returned by their own inserts/updates/deletes
+    (apply_written/forget), so readers see them without another Calendar
+    read. `version` grows with every change, letting readers tell whether
+    anything changed since they last looked.
+    """
+
+    def __init__(self, calendar_id, state_dir=None):
+        self.calendar_id = calendar_id
+        self.path = os.path.join(state_dir or STATE_DIR, f"events_{safe_filename(calendar_id)}.json")
+        self.events = {}
+        self.sync_token = None
+        self.version = 0
+        self._saved_version = 0
+        self.synced_at = None  # time.monotonic() of the last successful sync
+        self.lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.events = data.get("events", {})
+            self.sync_token = data.get("sync_token")
+        except Exception as e:
+            print(f"⚠️ Could not load event store {self.path}, doing a full sync: {e}")
+            self.events = {}
+            self.sync_token = None
+
+    def save(self, force=False):
+        """Write the store to disk if any event changed since the last save (or force)."""
+        with self.lock:
+            if not force and self.version == self._saved_version:
+                return
+            write_json_atomic(self.path, {"sync_token": self.sync_token, "events": self.events})
+            self._saved_version = self.version
+
+    def _list_pages(self, service, **params):
+        page_token = None
+        while True:
+            request = service.events().list(
+                calendarId=self.calendar_id, singleEvents=True, pageToken=page_token, **params
+            )
+
+            def attempt():
+                metrics.api_call("calendar", "list")
+                return request.execute()
+            # 429/5xx pages are retried behind the Calendar circuit breaker; a 410 is not
+            # retryable and reaches _sync, which falls back to a full resync
+            response = resilience.call_with_retry(attempt, CALENDAR_HOST, "calendar")
+            yield response
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return
+
+    def apply_written(self, event):
+        """Record an event returned by a successful insert/update."""
+        if event and event.get("id"):
+            with self.lock:
+                self._apply([event])
+
+    def forget(self, event_id):
+        """Drop an event this process deleted."""
+        with self.lock:
+            if self.events.pop(event_id, None) is not None:
+                self.version += 1
+
+    def _apply(self, items):
+        self.version += len(items)
+        for event in items:
+            if event.get("status") == "cancelled":
+                self.events.pop(event.get("id"), None)
+            else:
+                self.events[event["id"]] = event
+
+    def sync(self, service, max_age=None):
+        """Bring the store up to date using the googleapiclient service. Returns changed count.
+
+        With max_age (seconds), a store synced that recently is used as is.
+        """
+        with self.lock:
+            if max_age and self.synced_at is not None and time.monotonic() - self.synced_at < max_age:
+                return 0
+            changed = self._sync(service)
+            self.synced_at = time.monotonic()
+            return changed
+
+    def _sync(self, service):
+        if self.sync_token:
+            from googleapiclient.errors import HttpError
+            try:
+                return self._sync_pages(service, syncToken=self.sync_token)
+            except HttpError as e:
+                if getattr(e, "resp", None) is None or e.resp.status != 410:
+                    raise
+                print(f"♻️ Sync token expired for calendar {self.calendar_id}, doing a full resync")
+
+        self.events = {}
+        self.sync_token = None
+        return self._sync_pages(service, maxResults=2500)
+
+    def _sync_pages(self, service, **params):
+        changed = 0
+        next_sync_token = None
+        for response in self._list_pages(service, **params):
+            items = response.get("items", [])
+            self._apply(items)
+            changed += len(items)
+            next_sync_token = response.get("nextSyncToken") or next_sync_token
+        self.sync_token = next_sync_token
+        # A delta sync that found nothing leaves the file alone: its older token still
+        # yields exactly the changes since then, so only the in-memory token moves on
+        self.save(force="syncToken" not in params)
+        kind = "delta" if "syncToken" in params else "full"
+        print(f"🔁 {kind.capitalize()} sync of calendar {self.calendar_id}: {changed} change(s), {len(self.events)} event(s) stored")
+        return changed
+
+    def upcoming(self, now_utc):
+        """Return stored events whose timed end is after now_utc, leaving out tagged orphans."""
+        with self.lock:
+            events = list(self.events.values())
+        result = []
+        for event in events:
+            if event.get("extendedProperties", {}).get("private", {}).get(ORPHAN_PROPERTY):
+                continue
+            end_time = event.get("end", {}).get("dateTime")
+            if not end_time:
+                continue
+            try:
+                end = datetime.datetime.fromisoformat(end_time.replace("Z", "+00:00"))
+            except ValueError:
+                continue
+            if end.tzinfo is None:
+                end = end.replace(tzinfo=datetime.timezone.utc)
+            if end > now_utc:
+                result.append(event)
+        return result
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_event_store(calendar_id):
+    """Process-wide CalendarEventStore for calendar_id, shared by the sync and notify stages."""
+    with _stores_lock:
+        store = _stores.get(calendar_id)
+        if store is None:
+            store = _stores[calendar_id] = CalendarEventStore(calendar_id)
+        return store
@@ -1,23 +1,47 @@
+import time
+_PROCESS_START = time.perf_counter()
 import discord
+from discord import app_commands
 from discord.ext import commands, tasks
 import asyncio
 import datetime
+import hashlib
+import json
 from datetime import time as dtime
-from gcsa.google_calendar import GoogleCalendar
 from dotenv import load_dotenv
 import os
 from zoneinfo import ZoneInfo
-from api_bot import get_activities
-
-# Load environment variables
+# Load .env before the local modules, which read their settings (e.g. STATE_DIR, POLL_*) at import
 load_dotenv()
+from activity_store import get_activity_store
+from api_bot import TENANTS_FILE, get_activities, google_calendar_service, load_tenants, sync_tenant
+from calendar_store import STATE_DIR, get_event_store, write_json_atomic
+from jobs import JobScheduler
+import metrics
+import polling
+import reminders
+import resilience
+_IMPORTS_DONE = time.perf_counter()
+
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DISCORD_GUILD_ID = os.getenv("DISCORD_GUILD_ID")  # Optional: for faster command sync during testing
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS_PATH")
-GCSA_TOKEN_PATH = os.getenv("GCSA_TOKEN_PATH", "/home/kamin/.credentials/token.pickle")  # Default path for gcsa token
 DISCORD_BOT_STATUS_CHANEL = os.getenv("DISCORD_BOT_STATUS_CHANEL")
 FETCH_ON_START = os.getenv("FETCH_ON_START", "true").lower() == "true"  # Whether to fetch API on startup
-FETCH_AT_9AM = os.getenv("FETCH_AT_9AM", "true").lower() == "true"  # Whether to run scheduled fetch at 9AM
+FETCH_AT_9AM = os.getenv("FETCH_AT_9AM", "true").lower() == "true"  # Whether to fetch at the scheduled daily times
+DAILY_RUN_TIMES_RAW = os.getenv("DAILY_RUN_TIMES", "09:00")  # Comma-separated HH:MM, Bangkok time
+JOB_WORKERS = max(1, int(os.getenv("JOB_WORKERS", "2") or 2))  # Threads for blocking jobs
+NOTIFY_CONCURRENCY = max(1, int(os.getenv("NOTIFY_CONCURRENCY", "4") or 4))  # Calendars processed in parallel
+NOTIFY_BUDGET_SECONDS = float(os.getenv("NOTIFY_BUDGET_SECONDS", "0") or 0)  # Warn when a notify run takes longer (0 = off)
+MESSAGE_MODE = os.getenv("MESSAGE_MODE", "edit").lower()  # "edit" (reconcile in place) or "resend"
+FETCH_COOLDOWN_SECONDS = float(os.getenv("FETCH_COOLDOWN_SECONDS", "0") or 0)  # /fetch reuses a fetch finished this recently
+HOMEWORK_COOLDOWN_SECONDS = float(os.getenv("HOMEWORK_COOLDOWN_SECONDS", "0") or 0)  # /homework reuses a refresh finished this recently
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "300") or 300)  # /due answers from events at most this old, then refreshes
+CALENDAR_FRESH_SECONDS = float(os.getenv("CALENDAR_FRESH_SECONDS", "60") or 0)  # Skip the Calendar delta sync if the store synced this recently
+COMMAND_SYNC = os.getenv("COMMAND_SYNC", "auto").lower()  # "auto" (only when commands changed), "always" or "never"
+DISCORD_HOST = "discord.com"  # Circuit breaker key for Discord API calls
+CHANNEL_RATE = 5  # Discord allows about 5 message operations per 5 seconds per channel
+CHANNEL_RATE_PERIOD = 5.0
 print(f"🔑 Using Google credentials from {GOOGLE_CREDENTIALS}")
 print(f"⚙️ FETCH_ON_START: {FETCH_ON_START}")
 print(f"⚙️ FETCH_AT_9AM: {FETCH_AT_9AM}")
@@ -32,6 +56,12 @@ except Exception as e:
     print(f"❌ Error parsing CALENDAR_MAP: {e}")
     CALENDAR_MAP = {}
 
+# Tenants from TENANTS_FILE; empty means the single env-configured tenant
+TENANTS = load_tenants() if TENANTS_FILE else []
+for _tenant in TENANTS:
+    if _tenant.channel_id:
+        CALENDAR_MAP.setdefault(_tenant.calendar_id, _tenant.channel_id)
+
 if not CALENDAR_MAP:
     print("⚠️ No valid calendar-channel mappings found in CALENDAR_MAP.")
 
@@ -43,8 +73,81 @@ client = commands.Bot(command_prefix='/', intents=intents)
 # Constants and state for message handling
 BANGKOK_TZ = ZoneInfo("Asia/Bangkok")
 DISCORD_MESSAGE_LIMIT = 2000
+_FAR_FUTURE_BKK = datetime.datetime.max.replace(tzinfo=BANGKOK_TZ)
+BASE_SITE_URL = (os.getenv("BASE_SITE_URL") or "").strip().rstrip("/")
 # Track previously-sent message IDs per channel to delete cleanly next run
 _PREV_MESSAGE_IDS = {}
+# Hashes of those messages' content, used to skip edits of unchanged chunks
+_PREV_CHUNK_HASHES = {}
+# Last time each channel's notifications were refreshed (ISO timestamp)
+_LAST_SYNC = {}
+NOTIFY_STATE_PATH = os.path.join(STATE_DIR, "notify_state.json")
+# Hash of the slash commands last synced to Discord, per scope
+COMMAND_SYNC_PATH = os.path.join(STATE_DIR, "command_sync.json")
+# Store version each calendar's channel was last rendered from
+_RENDERED_VERSIONS = {}
+# Cached EventViews per calendar: {calendar_id: {event_id: EventView}}
+_VIEW_CACHE = {}
+# When each calendar's views were last refreshed (time.monotonic())
+_VIEW_CACHE_TIMES = {}
+# Background cache refreshes, kept referenced until they finish
+_REFRESH_TASKS = set()
+# Per-channel Discord request budgets
+_CHANNEL_BUDGETS = {}
+# Per-channel locks serializing message reconciliation (created lazily on the event loop)
+_CHANNEL_LOCKS = {}
+
+
+def _parse_daily_times(raw):
+    times = []
+    for part in raw.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            hour, minute = (int(x) for x in part.split(":"))
+            times.append(dtime(hour, minute, tzinfo=BANGKOK_TZ))
+        except ValueError:
+            print(f"❌ Invalid time in DAILY_RUN_TIMES: {part}")
+    return sorted(times) or [dtime(9, 0, tzinfo=BANGKOK_TZ)]
+
+
+DAILY_RUN_TIMES = _parse_daily_times(DAILY_RUN_TIMES_RAW)
+print(f"⚙️ DAILY_RUN_TIMES: {', '.join(t.strftime('%H:%M') for t in DAILY_RUN_TIMES)}")
+
+# Runs fetch/notify jobs off the event loop and deduplicates overlapping runs
+scheduler = JobScheduler(max_workers=JOB_WORKERS)
+
+
+class ChannelBudget:
+    """Async token bucket limiting Discord message operations for one channel."""
+
+    def __init__(self, rate=CHANNEL_RATE, period=CHANNEL_RATE_PERIOD):
+        self.capacity = rate
+        self.refill_per_sec = rate / period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_sec)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                metrics.rate_limited("discord")
+                await asyncio.sleep((1 - self._tokens) / self.refill_per_sec)
+
+
+def _channel_budget(channel_id):
+    budget = _CHANNEL_BUDGETS.get(channel_id)
+    if budget is None:
+        budget = ChannelBudget()
+        _CHANNEL_BUDGETS[channel_id] = budget
+    return budget
 
 
 def _safe_event_end_in_bkk(event):
@@ -53,8 +156,12 @@ def _safe_event_end_in_bkk(event):
     Handles cases where event.end may be a datetime, dict with 'dateTime'/'date',
     or missing/naive. For all-day (date-only) events, returns None.
     """
+    end = event.get("end") if isinstance(event, dict) else getattr(event, "end", None)
+    return _end_in_bkk(end)
+
+
+def _end_in_bkk(end):
     try:
-        end = getattr(event, "end", None)
         if not end:
             return None
         # Dict shape from some calendar libs
@@ -104,95 +211,310 @@ def _build_activity_link(description):
     class_id = parts[0] if len(parts) > 0 and parts[0] else "Unknown Class"
     activity_id = parts[1] if len(parts) > 1 and parts[1] else "Unknown Activity"
 
-    base = (os.getenv("BASE_SITE_URL") or "").strip()
-    if not base:
+    if not BASE_SITE_URL:
         return None, class_id, activity_id
-    base = base.rstrip("/")
-    return f"{base}/{class_id}/activity/{activity_id}", class_id, activity_id
+    return f"{BASE_SITE_URL}/{class_id}/activity/{activity_id}", class_id, activity_id
+
+
+class EventView:
+    """Pre-rendered view of one calendar event for the notification formatter.
+
+    Everything except the "time until" line is computed once per event
+    version (event id + `updated`) and reused across renders.
+    """
+
+    __slots__ = ("event_id", "updated", "end_bkk", "sort_key", "summary", "link", "static_block", "class_id")
+
+    def __init__(self, event_id, updated, end_bkk, summary, link, class_id=None):
+        self.event_id = event_id
+        self.class_id = class_id
+        self.updated = updated
+        self.end_bkk = end_bkk
+        # None -> far future so undated events are listed last
+        self.sort_key = end_bkk or _FAR_FUTURE_BKK
+        self.summary = summary
+        self.link = link
+        event_time = end_bkk.strftime("%d/%m/%y %H:%M") if end_bkk else "All day"
+        title = f"### [{summary}](<{link}>)\n" if link else f"### {summary}\n"
+        self.static_block = f"{title}📆 {event_time}\n"
+
+    @classmethod
+    def from_raw(cls, event):
+        """Build a view from a raw Calendar API event dict."""
+        link, class_id, _ = _build_activity_link(event.get("description"))
+        return cls(event.get("id"), event.get("updated"), _end_in_bkk(event.get("end")), event.get("summary", "Untitled"), link, class_id)
+
+
+def _event_views(calendar_id, raw_events):
+    """Return EventViews for raw_events, reusing cached views of unchanged events."""
+    cached = _VIEW_CACHE.get(calendar_id, {})
+    views = {}
+    for event in raw_events:
+        view = cached.get(event.get("id"))
+        if view is None or view.updated != event.get("updated"):
+            view = EventView.from_raw(event)
+        views[view.event_id] = view
+    # Replacing the dict drops views of events that are gone
+    _VIEW_CACHE[calendar_id] = views
+    return list(views.values())
 
 
 def _format_event_block(event, now_bkk):
-    end_bkk = _safe_event_end_in_bkk(event)
-    event_time = end_bkk.strftime("%d/%m/%y %H:%M") if end_bkk else "All day"
-    time_until_str = _format_time_until(end_bkk, now_bkk)
-
-    summary = getattr(event, "summary", "Untitled")
-    link, _, _ = _build_activity_link(getattr(event, "description", None))
-    title = f"### [{summary}](<{link}>)\n" if link else f"### {summary}\n"
-
-    return (
-        f"{title}"
-        f"📆 {event_time}\n"
-        f"⏳ {time_until_str}\n"
-    )
+    if not isinstance(event, EventView):
+        link, _, _ = _build_activity_link(getattr(event, "description", None))
+        event = EventView(None, None, _safe_event_end_in_bkk(event), getattr(event, "summary", "Untitled"), link)
+    return f"{event.static_block}⏳ {_format_time_until(event.end_bkk, now_bkk)}\n"
 
 
-async def format_and_send_events(events, now, channel):
-    """Format events and send to the given Discord channel.
+def _load_notification_state():
+    """Restore message IDs, chunk hashes and sync times saved by a previous run."""
+    if not os.path.exists(NOTIFY_STATE_PATH):
+        return
+    try:
+        with open(NOTIFY_STATE_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for channel_id, entry in data.get("channels", {}).items():
+            channel_id = int(channel_id)
+            _PREV_MESSAGE_IDS[channel_id] = [int(m) for m in entry.get("message_ids", [])]
+            _PREV_CHUNK_HASHES[channel_id] = entry.get("chunk_hashes", [])
+            if entry.get("last_sync"):
+                _LAST_SYNC[channel_id] = entry["last_sync"]
+        print(f"💾 Restored notification state for {len(_PREV_MESSAGE_IDS)} channel(s)")
+    except Exception as e:
+        print(f"⚠️ Could not load notification state from {NOTIFY_STATE_PATH}: {e}")
 
-    - Deletes messages previously sent by this function for the channel.
-    - Sorts events by end time in Bangkok tz.
-    - Chunks output to respect Discord 2000-char limit.
-    """
-    # Delete previously sent messages for this channel
-    channel_ids = _PREV_MESSAGE_IDS.get(channel.id, [])
-    if channel_ids:
-        for msg_id in channel_ids:
-            try:
-                msg = await channel.fetch_message(msg_id)
-                await msg.delete()
-                await asyncio.sleep(0.5)  # Tread lightly re: rate limits
-            except Exception as e:
-                print(f"⚠️ Could not delete message ID {msg_id} in channel {channel.id}: {e}")
-    _PREV_MESSAGE_IDS[channel.id] = []
 
+def _save_notification_state():
+    channels = {
+        str(channel_id): {
+            "message_ids": msg_ids,
+            "chunk_hashes": _PREV_CHUNK_HASHES.get(channel_id, []),
+            "last_sync": _LAST_SYNC.get(channel_id),
+        }
+        for channel_id, msg_ids in _PREV_MESSAGE_IDS.items()
+    }
     try:
-        now_bkk = now.astimezone(BANGKOK_TZ)
+        write_json_atomic(NOTIFY_STATE_PATH, {"channels": channels})
+    except Exception as e:
+        print(f"⚠️ Could not save notification state to {NOTIFY_STATE_PATH}: {e}")
 
-        # Sort events by end time (None -> far future to send last)
-        events.sort(key=lambda e: _safe_event_end_in_bkk(e) or datetime.datetime.max.replace(tzinfo=BANGKOK_TZ))
 
-        header = "## Activities\n\n"
-        current_msg = header
-        chunks = []
+def _chunk_hash(content):
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
 
-        for event in events:
-            block = _format_event_block(event, now_bkk)
-            if len(current_msg) + len(block) > DISCORD_MESSAGE_LIMIT:
-                # Push the current chunk and start a new one without repeating header
-                chunks.append(current_msg.rstrip())
-                current_msg = block
-            else:
-                current_msg += block
-
-        if current_msg.strip():
+
+def _build_message_chunks(events, now_bkk, header="## Activities\n\n"):
+    """Sort events by end time and render them into <=2000-char message chunks."""
+    # Sort events by end time (None -> far future to send last)
+    events.sort(key=lambda e: e.sort_key if isinstance(e, EventView) else (_safe_event_end_in_bkk(e) or _FAR_FUTURE_BKK))
+
+    current_msg = header
+    chunks = []
+
+    for event in events:
+        block = _format_event_block(event, now_bkk)
+        if len(current_msg) + len(block) > DISCORD_MESSAGE_LIMIT:
+            # Push the current chunk and start a new one without repeating header
             chunks.append(current_msg.rstrip())
+            current_msg = block
+        else:
+            current_msg += block
+
+    if current_msg.strip():
+        chunks.append(current_msg.rstrip())
+    return chunks
+
+
+async def _discord_call(op, channel, coro_factory):
+    """Run one Discord message operation within the channel's budget.
+
+    Server errors and connection failures are retried with backoff; discord.py
+    already waits out 429s itself.
+    """
+    async def attempt():
+        await _channel_budget(channel.id).acquire()
+        metrics.api_call("discord", op)
+        return await coro_factory()
+    return await resilience.async_call_with_retry(attempt, DISCORD_HOST, "discord")
+
+
+async def _delete_messages(channel, msg_ids):
+    """Delete messages by ID, in bulk when possible, one by one otherwise."""
+    if not msg_ids:
+        return
+    if len(msg_ids) > 1 and hasattr(channel, "delete_messages"):
+        try:
+            with metrics.timed("discord_delete", mode="bulk"):
+                await _discord_call("bulk_delete", channel, lambda: channel.delete_messages([discord.Object(id=m) for m in msg_ids]))
+            return
+        except Exception as e:
+            # Bulk delete needs Manage Messages and messages younger than 14 days
+            print(f"⚠️ Bulk delete failed in channel {channel.id}, deleting one by one: {e}")
+    for msg_id in msg_ids:
+        try:
+            # Deleting by ID avoids a fetch_message round-trip
+            with metrics.timed("discord_delete", mode="single"):
+                await _discord_call("delete", channel, lambda: channel.get_partial_message(msg_id).delete())
+        except Exception as e:
+            print(f"⚠️ Could not delete message ID {msg_id} in channel {channel.id}: {e}")
+
+
+async def _send_chunks(channel, chunks, msg_ids=None, hashes=None):
+    """Send chunks, appending each message's ID (and content hash) as soon as it is sent."""
+    msg_ids = [] if msg_ids is None else msg_ids
+    for content in chunks:
+        with metrics.timed("discord_send"):
+            sent = await _discord_call("send", channel, lambda: channel.send(content))
+        msg_ids.append(sent.id)
+        if hashes is not None:
+            hashes.append(_chunk_hash(content))
+    return msg_ids
+
+
+def _remember_messages(channel_id, msg_ids, hashes, now=None):
+    _PREV_MESSAGE_IDS[channel_id] = msg_ids
+    _PREV_CHUNK_HASHES[channel_id] = hashes
+    if now is not None:
+        _LAST_SYNC[channel_id] = now.isoformat()
+    _save_notification_state()
 
-        # Send chunks and remember their IDs for later cleanup
-        for content in chunks:
-            sent = await channel.send(content)
-            _PREV_MESSAGE_IDS[channel.id].append(sent.id)
-            await asyncio.sleep(0.5)  # Avoid rate limits
+
+async def _reconcile_messages(channel, chunks):
+    """Edit changed messages in place, send extra chunks and delete surplus ones.
+
+    Messages whose stored content hash already matches their chunk are left alone.
+    Returns the new message IDs and content hashes. If a Discord call fails
+    partway, the messages handled so far and the old ones not reached yet are
+    remembered before re-raising, so the next run edits them instead of
+    leaving untracked duplicates.
+    """
+    old_ids = _PREV_MESSAGE_IDS.get(channel.id, [])
+    old_hashes = _PREV_CHUNK_HASHES.get(channel.id, [])
+    msg_ids = []
+    hashes = []
+    done = 0  # Old messages handled so far
+    edited = unchanged = 0
+
+    try:
+        for i, content in enumerate(chunks):
+            if i >= len(old_ids):
+                await _send_chunks(channel, chunks[i:], msg_ids, hashes)
+                break
+            msg_id = old_ids[i]
+            content_hash = _chunk_hash(content)
+            if i < len(old_hashes) and old_hashes[i] == content_hash:
+                msg_ids.append(msg_id)
+                hashes.append(content_hash)
+                unchanged += 1
+                done = i + 1
+                continue
+            try:
+                with metrics.timed("discord_edit"):
+                    await _discord_call("edit", channel, lambda: channel.get_partial_message(msg_id).edit(content=content))
+                msg_ids.append(msg_id)
+                hashes.append(content_hash)
+                edited += 1
+            except discord.NotFound:
+                # Someone deleted our message; post a replacement
+                await _send_chunks(channel, [content], msg_ids, hashes)
+            done = i + 1
+    except Exception:
+        _remember_messages(channel.id, msg_ids + old_ids[done:], hashes + old_hashes[done:])
+        raise
+
+    await _delete_messages(channel, old_ids[len(chunks):])
+    print(f"🧾 Channel {channel.id}: {edited} edited, {unchanged} unchanged, {max(0, len(msg_ids) - edited - unchanged)} sent, {max(0, len(old_ids) - len(chunks))} deleted")
+    return msg_ids, hashes
+
+
+async def format_and_send_events(events, now, channel):
+    """Format events and send to the given Discord channel.
+
+    - Sorts events by end time in Bangkok tz.
+    - Chunks output to respect Discord 2000-char limit.
+    - With MESSAGE_MODE=edit, reconciles with the messages sent last time
+      (edit changed, send extra, delete surplus); with MESSAGE_MODE=resend,
+      deletes the previous messages and sends everything again.
+
+    Returns True once the channel is up to date, False if sending failed.
+    """
+    try:
+        now_bkk = now.astimezone(BANGKOK_TZ)
+        chunks = _build_message_chunks(events, now_bkk)
+        lock = _CHANNEL_LOCKS.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            await _publish_chunks(channel, chunks, now)
+        return True
 
     except Exception as e:
         ch = getattr(channel, "id", "unknown")
         print(f"❌ Error sending events for channel {ch}: {e}")
+        return False
+
+
+async def _publish_chunks(channel, chunks, now):
+    """Replace the channel's previous notification messages with chunks (caller holds the channel lock)."""
+    if MESSAGE_MODE == "edit":
+        msg_ids, hashes = await _reconcile_messages(channel, chunks)
+    else:
+        # Delete previously sent messages for this channel
+        await _delete_messages(channel, _PREV_MESSAGE_IDS.get(channel.id, []))
+        _remember_messages(channel.id, [], [])
+        # Send chunks and remember their IDs for later cleanup, even if a send fails partway
+        msg_ids, hashes = [], []
+        try:
+            await _send_chunks(channel, chunks, msg_ids, hashes)
+        except Exception:
+            _remember_messages(channel.id, msg_ids, hashes)
+            raise
+
+    _remember_messages(channel.id, msg_ids, hashes, now)
 
 
 # Fetch and send only events that have not ended yet
-async def send_event_notifications():
+async def send_event_notifications(only_if_changed=False):
+    """Refresh every mapped channel; with only_if_changed, only those whose calendar changed."""
     now_utc = datetime.datetime.now(datetime.timezone.utc)
     now_bkk = now_utc.astimezone(BANGKOK_TZ)
     print(f"🔎 Checking calendars at {now_utc.isoformat()}")
 
-    for calendar_id, channel_id in CALENDAR_MAP.items():
-        await _process_calendar(calendar_id, channel_id, now_utc, now_bkk)
+    # Process calendars concurrently, at most NOTIFY_CONCURRENCY at a time
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def process(calendar_id, channel_id):
+        async with semaphore:
+            await _process_calendar(calendar_id, channel_id, now_utc, now_bkk, only_if_changed)
 
+    with metrics.timed("notify_run", budget=NOTIFY_BUDGET_SECONDS or None):
+        await asyncio.gather(*(process(cal, chan) for cal, chan in CALENDAR_MAP.items()))
 
-async def _process_calendar(calendar_id, channel_id, now_utc, now_bkk):
+
+def _load_upcoming_events(calendar_id, now_utc):
+    """Bring the shared event store up to date; return (store version, upcoming EventViews) (blocking).
+
+    The store is the same one the fetch job writes through, so events it just
+    wrote are already there and a store synced within CALENDAR_FRESH_SECONDS
+    is read without calling Google at all.
+    """
+    store = get_event_store(calendar_id)
+    with metrics.timed("calendar_sync", calendar=calendar_id):
+        store.sync(google_calendar_service(), max_age=CALENDAR_FRESH_SECONDS)
+        # Read the version first: a write landing meanwhile makes the next poll re-render
+        version = store.version
+        views = _event_views(calendar_id, store.upcoming(now_utc))
+        _VIEW_CACHE_TIMES[calendar_id] = time.monotonic()
+        return version, views
+
+
+async def _process_calendar(calendar_id, channel_id, now_utc, now_bkk, only_if_changed=False):
     try:
-        gc = GoogleCalendar(calendar_id, credentials_path=GOOGLE_CREDENTIALS, token_path=GCSA_TOKEN_PATH)
-        events = list(gc.get_events(time_min=now_utc))
+        # Google calls are blocking; keep them off the event loop
+        version, events = await asyncio.to_thread(_load_upcoming_events, calendar_id, now_utc)
+        if only_if_changed and _RENDERED_VERSIONS.get(calendar_id) == version:
+            print(f"💤 No calendar changes for {calendar_id}, leaving channel {channel_id} as is")
+            return
+        if reminder_scheduler is not None:
+            reminder_scheduler.update_calendar(calendar_id, channel_id, events, now_bkk)
 
         if not events:
             print(f"📭 No events returned for calendar {calendar_id}")
@@ -201,12 +523,8 @@ async def _process_calendar(calendar_id, channel_id, now_utc, now_bkk):
         # Filter out events that have already ended (using Bangkok tz consistency)
         upcoming_events = []
         for event in events:
-            try:
-                end_bkk = _safe_event_end_in_bkk(event)
-                if end_bkk and end_bkk > now_bkk:
-                    upcoming_events.append(event)
-            except Exception as e:
-                print(f"⚠️ Skipping event due to parsing error: {e}")
+            if event.end_bkk and event.end_bkk > now_bkk:
+                upcoming_events.append(event)
 
         if not upcoming_events:
             print(f"⌛ No valid upcoming events for calendar {calendar_id}")
@@ -221,12 +539,51 @@ async def _process_calendar(calendar_id, channel_id, now_utc, now_bkk):
             f"📡 Sending {len(upcoming_events)} event(s) for calendar {calendar_id} "
             f"to channel {getattr(channel, 'name', 'unknown')} ({channel_id})"
         )
-        await format_and_send_events(upcoming_events, now_utc, channel)
+        # Only a channel that was fully updated counts as rendered; a failed send is retried next poll
+        if await format_and_send_events(upcoming_events, now_utc, channel):
+            _RENDERED_VERSIONS[calendar_id] = version
 
     except Exception as e:
         print(f"❌ Error processing calendar {calendar_id}: {e}")
 
 
+async def run_fetch_job(tenants=None, cooldown=0):
+    """Fetch activities into Google Calendar, one 'fetch:<tenant>' job per tenant.
+
+    Tenants run side by side on the job executor; one tenant failing does not
+    stop the others. Raises only if every tenant failed. Callers arriving while
+    a tenant's fetch runs (or within `cooldown` seconds after it) share its result.
+    """
+    if not TENANTS:
+        return await scheduler.run("fetch", get_activities, cooldown=cooldown)
+
+    if tenants is None:
+        tenants = TENANTS
+    results = await asyncio.gather(
+        *(scheduler.run(f"fetch:{tenant.name}", sync_tenant, tenant, cooldown=cooldown) for tenant in tenants),
+        return_exceptions=True,
+    )
+    failures = [(tenant, r) for tenant, r in zip(tenants, results) if isinstance(r, BaseException)]
+    for tenant, error in failures:
+        print(f"❌ Fetch failed for tenant {tenant.name}: {error}")
+    if failures and len(failures) == len(tenants):
+        raise failures[0][1]
+    return results
+
+
+def _tenants_for_channel(channel_id):
+    """Tenants whose calendar is posted to channel_id."""
+    return [
+        t for t in TENANTS
+        if t.channel_id == channel_id or CALENDAR_MAP.get(t.calendar_id) == channel_id
+    ]
+
+
+async def run_notify_job():
+    """Send notifications for all calendars as the shared 'notify' job."""
+    return await scheduler.run("notify", send_event_notifications, blocking=False)
+
+
 async def _resolve_channel(channel_id):
     ch = client.get_channel(channel_id)
     if ch:
@@ -258,7 +615,7 @@ async def send_startup_message():
             f"✅ Discord Homework Notify bot is now running!\n"
             f"⏰ Started at: {startup_time} (Bangkok Time)\n\n"
             f"📅 Monitoring {len(CALENDAR_MAP)} calendar(s):\n{calendar_list}\n\n"
-            f"🔔 Daily notifications at 9:00 AM Bangkok time\n"
+            f"🔔 Daily notifications at {', '.join(t.strftime('%H:%M') for t in DAILY_RUN_TIMES)} Bangkok time\n"
         )
         
         await channel.send(message)
@@ -278,18 +635,205 @@ async def fetch(interaction: discord.Interaction):
     if interaction.channel.id not in CALENDAR_MAP.values():
         await interaction.response.send_message("❌ This command can only be used in homework notification channels.", ephemeral=True)
         return
+
+    tenants = _tenants_for_channel(interaction.channel.id)
+    if TENANTS and not tenants:
+        await interaction.response.send_message("❌ No tenant in TENANTS_FILE posts to this channel, nothing to fetch.", ephemeral=True)
+        return
     
     await interaction.response.send_message("🔄 Fetching activities from external API...")
     
     try:
-        # Run get_activities in a thread to avoid blocking
-        await asyncio.to_thread(get_activities)
+        # Runs on the job executor; joins an in-flight fetch instead of starting another
+        await run_fetch_job(tenants, cooldown=FETCH_COOLDOWN_SECONDS)
         await interaction.followup.send("✅ Successfully fetched and updated activities in Google Calendar!")
     except Exception as e:
         await interaction.followup.send(f"❌ Error fetching activities: {e}")
         print(f"❌ Error in /fetch command: {e}")
 
 
+def _calendar_for_channel(channel_id):
+    for cal_id, chan_id in CALENDAR_MAP.items():
+        if chan_id == channel_id:
+            return cal_id
+    return None
+
+
+async def _refresh_views(calendar_id):
+    """Re-sync calendar_id's views; concurrent callers share one refresh."""
+    async def refresh():
+        now_utc = datetime.datetime.now(datetime.timezone.utc)
+        await asyncio.to_thread(_load_upcoming_events, calendar_id, now_utc)
+    await scheduler.run(f"views:{calendar_id}", refresh, blocking=False)
+
+
+def _log_refresh_failure(task):
+    _REFRESH_TASKS.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"⚠️ Background refresh failed: {task.exception()}")
+
+
+async def _cached_views(calendar_id):
+    """Return calendar_id's cached EventViews, serving stale ones while a refresh runs.
+
+    Only a calendar with no cached views at all waits for the Google API.
+    """
+    loaded_at = _VIEW_CACHE_TIMES.get(calendar_id)
+    if loaded_at is None:
+        await _refresh_views(calendar_id)
+    elif time.monotonic() - loaded_at > QUERY_CACHE_TTL_SECONDS and not scheduler.is_running(f"views:{calendar_id}"):
+        task = asyncio.create_task(_refresh_views(calendar_id))
+        _REFRESH_TASKS.add(task)
+        task.add_done_callback(_log_refresh_failure)
+    return list(_VIEW_CACHE.get(calendar_id, {}).values())
+
+
+def _filter_views(views, now_bkk, class_name=None, days=None, limit=None):
+    """Upcoming views, optionally only one class (name or ID), due within `days`, first `limit`."""
+    selected = [v for v in views if v.end_bkk and v.end_bkk > now_bkk]
+    if class_name:
+        needle = class_name.strip().lower()
+        selected = [
+            v for v in selected
+            if v.class_id == needle or needle in v.summary.split(" - ", 1)[0].lower()
+        ]
+    if days:
+        until = now_bkk + datetime.timedelta(days=days)
+        selected = [v for v in selected if v.end_bkk <= until]
+    selected.sort(key=lambda v: v.sort_key)
+    return selected[:limit] if limit else selected
+
+
+def _activity_stores_for_channel(channel_id, calendar_id):
+    """Non-empty activity indexes of the tenants posting to channel_id (the env tenant is named after its calendar)."""
+    names = [t.name for t in _tenants_for_channel(channel_id)] or [calendar_id]
+    return [store for store in map(get_activity_store, names) if len(store)]
+
+
+def _query_activity_stores(stores, now_bkk, class_name=None, days=None, limit=None):
+    """Like _filter_views, but answered from the activity indexes without touching the calendar."""
+    start = int(now_bkk.timestamp()) + 1
+    end = int((now_bkk + datetime.timedelta(days=days)).timestamp()) + 1 if days else float("inf")
+    needle = class_name.strip().lower() if class_name else None
+    selected = []
+    for store in stores:
+        class_ids = None
+        if needle:
+            class_ids = [
+                class_id for class_id in set(store.classes()) | set(store.class_names)
+                if str(class_id) == needle or needle in store.class_names.get(class_id, "").lower()
+            ]
+            if not class_ids:
+                continue
+        for record in store.due_between(start, end, class_ids):
+            link = f"{BASE_SITE_URL}/{record.class_id}/activity/{record.activity_id}" if BASE_SITE_URL else None
+            selected.append(EventView(
+                record.key, None, record.due_bkk, f"{record.class_name} - {record.title}", link, str(record.class_id),
+            ))
+    selected.sort(key=lambda v: v.sort_key)
+    return selected[:limit] if limit else selected
+
+
+class PageView(discord.ui.View):
+    """Previous/next buttons for flipping through pre-rendered message pages."""
+
+    def __init__(self, pages):
+        super().__init__(timeout=300)
+        self.pages = pages
+        self.index = 0
+        self._update_buttons()
+
+    def content(self):
+        return f"{self.pages[self.index]}\n\n-# Page {self.index + 1}/{len(self.pages)}"
+
+    def _update_buttons(self):
+        self.previous.disabled = self.index == 0
+        self.next.disabled = self.index >= len(self.pages) - 1
+
+    async def _show(self, interaction, step):
+        self.index = max(0, min(len(self.pages) - 1, self.index + step))
+        self._update_buttons()
+        await interaction.response.edit_message(content=self.content(), view=self)
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, -1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, 1)
+
+
+@client.tree.command(name="due", description="Show upcoming homework for this channel (only visible to you)")
+@app_commands.describe(
+    class_name="Only this class (name or ID)",
+    days="Only homework due within this many days",
+    limit="Show at most this many activities",
+)
+async def due(
+    interaction: discord.Interaction,
+    class_name: str = None,
+    days: app_commands.Range[int, 1, 365] = None,
+    limit: app_commands.Range[int, 1, 100] = None,
+):
+    """Answer from the activity index (or the cached calendar view); the channel's messages are left untouched"""
+    calendar_id = _calendar_for_channel(interaction.channel.id)
+    if not calendar_id:
+        await interaction.response.send_message("❌ This command can only be used in homework notification channels.", ephemeral=True)
+        return
+
+    stores = _activity_stores_for_channel(interaction.channel.id, calendar_id)
+    cold = not stores and calendar_id not in _VIEW_CACHE_TIMES
+    if stores:
+        # The fetch job keeps the index current; no Google request needed
+        source = "index"
+        selected = _query_activity_stores(stores, datetime.datetime.now(BANGKOK_TZ), class_name, days, limit)
+    else:
+        source = "cold" if cold else "warm"
+        selected = await _due_from_calendar(interaction, calendar_id, cold, class_name, days, limit)
+        if selected is None:
+            return
+    await _send_due(interaction, selected, cold, source)
+
+
+async def _due_from_calendar(interaction, calendar_id, cold, class_name, days, limit):
+    """/due's fallback before the first fetch: filter the cached calendar views (None after reporting an error)."""
+    if cold:
+        # Nothing cached yet: acknowledge within Discord's 3s window while the calendar loads
+        await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        views = await _cached_views(calendar_id)
+    except Exception as e:
+        print(f"❌ Error in /due command: {e}")
+        message = f"❌ Could not load homework: {e}"
+        if cold:
+            await interaction.followup.send(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(message, ephemeral=True)
+        return None
+    return _filter_views(views, datetime.datetime.now(BANGKOK_TZ), class_name, days, limit)
+
+
+async def _send_due(interaction, selected, cold, source):
+    now_bkk = datetime.datetime.now(BANGKOK_TZ)
+    if selected:
+        pages = _build_message_chunks(selected, now_bkk, header=f"## Upcoming ({len(selected)})\n\n")
+        pager = PageView(pages) if len(pages) > 1 else None
+        content = pager.content() if pager else pages[0]
+    else:
+        pager = None
+        content = "🎉 No matching homework due."
+
+    kwargs = {"ephemeral": True}
+    if pager:
+        kwargs["view"] = pager
+    metrics.inc("query_commands_total", command="due", cache=source)
+    if cold:
+        await interaction.followup.send(content, **kwargs)
+    else:
+        await interaction.response.send_message(content, **kwargs)
+
+
 @client.tree.command(name="homework", description="Send homework notifications for this channel")
 async def homework(interaction: discord.Interaction):
     """Notify homework for this channel - only works in mapped channels"""
@@ -299,11 +843,7 @@ async def homework(interaction: discord.Interaction):
         return
     
     # Find the calendar ID for this channel
-    calendar_id = None
-    for cal_id, chan_id in CALENDAR_MAP.items():
-        if chan_id == interaction.channel.id:
-            calendar_id = cal_id
-            break
+    calendar_id = _calendar_for_channel(interaction.channel.id)
     
     if not calendar_id:
         await interaction.response.send_message("❌ No calendar mapping found for this channel.", ephemeral=True)
@@ -316,29 +856,114 @@ async def homework(interaction: discord.Interaction):
         now_bkk = now_utc.astimezone(BANGKOK_TZ)
         
         # Process just this channel's calendar
-        await _process_calendar(calendar_id, interaction.channel.id, now_utc, now_bkk)
+        await scheduler.run(
+            f"notify:{calendar_id}", _process_calendar, calendar_id, interaction.channel.id, now_utc, now_bkk,
+            blocking=False, cooldown=HOMEWORK_COOLDOWN_SECONDS,
+        )
         await interaction.followup.send("✅ Homework notifications sent!")
     except Exception as e:
         await interaction.followup.send(f"❌ Error sending homework notifications: {e}")
         print(f"❌ Error in /homework command: {e}")
 
 
-# Daily 9AM loop
-@tasks.loop(time=dtime(9, 0))
+# Daily scheduled loop (DAILY_RUN_TIMES, Bangkok time)
+@tasks.loop(time=DAILY_RUN_TIMES)
 async def check_calendar():
     if FETCH_AT_9AM:
-        print("🔄 Running scheduled 9AM fetch...")
-        get_activities()
+        print("🔄 Running scheduled fetch...")
+        try:
+            await run_fetch_job()
+        except Exception as e:
+            print(f"❌ Scheduled fetch failed: {e}")
     else:
-        print("⏭️ Skipping 9AM fetch (FETCH_AT_9AM=false)")
-    await send_event_notifications()
+        print("⏭️ Skipping scheduled fetch (FETCH_AT_9AM=false)")
+    await run_notify_job()
 
-# On bot ready
-@client.event
-async def on_ready():
 
-    print(f"✅ Logged in as {client.user}")
-    
+def _next_due_bkk(now_bkk):
+    """Earliest upcoming due time across the cached calendar views, or None."""
+    # _event_views adds calendars from worker threads; iterate over snapshots
+    ends = [
+        view.end_bkk
+        for views in list(_VIEW_CACHE.values())
+        for view in list(views.values())
+        if view.end_bkk and view.end_bkk > now_bkk
+    ]
+    return min(ends, default=None)
+
+
+async def run_poll_cycle():
+    """Fetch activities, then update only the channels whose calendar changed."""
+    try:
+        await run_fetch_job()
+    except Exception as e:
+        print(f"❌ Poll fetch failed: {e}")
+    await scheduler.run("poll-notify", send_event_notifications, True, blocking=False)
+
+
+async def poll_loop():
+    """Poll at adaptive intervals (see polling.next_poll_delay) between the daily runs."""
+    while True:
+        try:
+            now_bkk = datetime.datetime.now(BANGKOK_TZ)
+            delay = polling.next_poll_delay(now_bkk, _next_due_bkk(now_bkk))
+        except Exception as e:
+            delay = polling.POLL_MIN_MINUTES * 60
+            print(f"❌ Could not compute the next poll time, using {polling.POLL_MIN_MINUTES:.0f} min: {e}")
+        print(f"🕒 Next poll in {delay / 60:.0f} min")
+        await asyncio.sleep(delay)
+        try:
+            await run_poll_cycle()
+        except Exception as e:
+            print(f"❌ Poll failed: {e}")
+
+
+async def _send_reminders(channel_id, due):
+    """Post one "due in ..." message per reminder offset for the given (EventView, offset) pairs."""
+    channel = await _resolve_channel(channel_id)
+    if not channel:
+        print(f"❌ Discord channel ID {channel_id} not found for reminders.")
+        return
+    now_bkk = datetime.datetime.now(BANGKOK_TZ)
+    by_offset = {}
+    for view, offset in due:
+        by_offset.setdefault(offset, []).append(view)
+    for offset, views in sorted(by_offset.items(), reverse=True):
+        header = f"## ⏰ Due within {reminders.format_offset(offset)}\n\n"
+        await _send_chunks(channel, _build_message_chunks(views, now_bkk, header))
+        print(f"⏰ Sent {len(views)} reminder(s) to channel {channel_id}")
+
+
+# Pre-deadline pings (REMINDER_OFFSETS); one task serves every channel
+reminder_scheduler = reminders.ReminderScheduler(reminders.REMINDER_OFFSETS, _send_reminders) if reminders.REMINDER_OFFSETS else None
+
+_startup_task = None
+_poll_task = None
+_reminder_task = None
+
+
+def _command_tree_hash(scope):
+    commands_payload = [command.to_dict(client.tree) for command in client.tree.get_commands()]
+    raw = json.dumps({"scope": scope, "application": client.application_id, "commands": commands_payload}, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def sync_commands():
+    """Sync slash commands with Discord, skipping it when they match the last sync (COMMAND_SYNC=auto)."""
+    if COMMAND_SYNC == "never":
+        print("⏭️ Skipping command sync (COMMAND_SYNC=never)")
+        return
+    scope = f"guild:{DISCORD_GUILD_ID}" if DISCORD_GUILD_ID else "global"
+    try:
+        with open(COMMAND_SYNC_PATH, "r", encoding="utf-8") as f:
+            synced_hashes = json.load(f)
+    except (OSError, ValueError):
+        synced_hashes = {}
+    digest = _command_tree_hash(scope)
+    if COMMAND_SYNC == "auto" and synced_hashes.get(scope) == digest:
+        print("⏭️ Slash commands unchanged since the last sync, skipping")
+        return
+
     # Sync slash commands with Discord
     try:
         if DISCORD_GUILD_ID:
@@ -353,20 +978,56 @@ async def on_ready():
             print(f"🔄 Synced {len(synced)} command(s) globally (may take up to 1 hour)")
     except Exception as e:
         print(f"❌ Failed to sync commands: {e}")
-    
-    if not check_calendar.is_running():
-        check_calendar.start()
-    
+        return
+    synced_hashes[scope] = digest
+    write_json_atomic(COMMAND_SYNC_PATH, synced_hashes)
+
+
+async def run_startup_jobs():
+    """Command sync, startup fetch and notify, run in the background once the bot is ready."""
+    await sync_commands()
     await send_startup_message()
-    
+
     if FETCH_ON_START:
         print("🚀 Running startup fetch (FETCH_ON_START=true)...")
-        get_activities()
+        try:
+            await run_fetch_job()
+        except Exception as e:
+            print(f"❌ Startup fetch failed: {e}")
     else:
         print("⏭️ Skipping startup fetch (FETCH_ON_START=false)")
+
+    await run_notify_job()
+
+# On bot ready
+@client.event
+async def on_ready():
+
+    print(f"✅ Logged in as {client.user}")
     
-    await send_event_notifications()
-    await asyncio.sleep(1)
+    if not check_calendar.is_running():
+        check_calendar.start()
+    
+    # on_ready can fire again after reconnects; only run the startup jobs once
+    global _startup_task, _poll_task, _reminder_task
+    if _startup_task is None:
+        ready = time.perf_counter() - _PROCESS_START
+        metrics.observe("startup_seconds", ready, phase="ready")
+        print(f"⚡ Ready {ready:.2f}s after start")
+        _startup_task = asyncio.create_task(run_startup_jobs())
+    if _poll_task is None and polling.polling_enabled():
+        _poll_task = asyncio.create_task(poll_loop())
+    if _reminder_task is None and reminder_scheduler is not None:
+        _reminder_task = asyncio.create_task(reminder_scheduler.run())
+
+# Restore state before any notification run so old messages can be reconciled
+_load_notification_state()
+
+metrics.observe("startup_seconds", _IMPORTS_DONE - _PROCESS_START, phase="imports")
+print(f"⚡ Imports took {(_IMPORTS_DONE - _PROCESS_START) * 1000:.0f} ms, module setup {(time.perf_counter() - _IMPORTS_DONE) * 1000:.0f} ms")
+
+# Expose /metrics when METRICS_PORT is set
+metrics.start_metrics_server()
 
 # Run the bot
 if DISCORD_TOKEN:
@@ -1,62 +1,239 @@
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+import argparse
+import collections
+import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from api_bot import BANGKOK_TZ, BATCH_SIZE, CalendarBatchWriter, _execute, get_tracking_key, google_calendar_service, is_orphan, tenant_for_calendar, upstream_keys
+from calendar_store import STATE_DIR, get_event_store, safe_filename, write_json_atomic
 from datetime import datetime, timezone
 
-# Calendar API scope
-SCOPES = ['https://www.googleapis.com/auth/calendar']
 calendar_id = os.getenv("GOOGLE_CALENDAR_ID")
+DELETE_CONCURRENCY = max(1, int(os.getenv("DELETE_CONCURRENCY", "4") or 4))  # Batch requests in flight at once
+LIST_PAGE_SIZE = 2500  # Calendar API maximum for events.list
+MAX_PASSES = 5  # Re-list until nothing matching is left, in case deletes shifted page tokens
+DRY_RUN_SAMPLE = 20
 
-# Load credentials and return a Google Calendar service object
-def google_calendar_service():
-    creds = None
-    TOKEN_PATH = os.getenv('GOOGLE_TOKEN_PATH')
-    
-    if os.path.exists(TOKEN_PATH):
-        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
-    
-    if not creds or not creds.valid:
-        flow = InstalledAppFlow.from_client_secrets_file(os.getenv("GOOGLE_CREDENTIALS_PATH"), SCOPES)
-        creds = flow.run_local_server(port=0)
-        with open(TOKEN_PATH, 'w') as token_file:
-            token_file.write(creds.to_json())
-    
-    return build('calendar', 'v3', credentials=creds)
-
-# Fetch all events from a calendar (with pagination)
-def get_all_events(service, calendar_id):
-    events = []
-    page_token = None
+# Stream a calendar's events one page at a time: yields (events, next_page_token)
+def iter_event_pages(service, calendar_id, time_min=None, time_max=None, page_token=None):
+    params = {"calendarId": calendar_id, "maxResults": LIST_PAGE_SIZE}
+    if time_min:
+        params["timeMin"] = time_min
+    if time_max:
+        params["timeMax"] = time_max
 
     while True:
-        response = service.events().list(calendarId=calendar_id, pageToken=page_token).execute()
-        events.extend(response.get('items', []))
+        response = _execute(service.events().list(pageToken=page_token, **params), "list")
         page_token = response.get('nextPageToken')
+        yield response.get('items', []), page_token
         if not page_token:
-            break
+            return
 
-    return events
+# Fetch all events from a calendar (with pagination)
+def get_all_events(service, calendar_id):
+    return [event for page, _ in iter_event_pages(service, calendar_id) for event in page]
 
-# Clear all events from a calendar
-def clear_calendar(calendar_id='primary'):
-    service = google_calendar_service()
-    events = get_all_events(service, calendar_id)
 
-    print(f"Found {len(events)} events. Starting deletion...")
+class EventFilter:
+    """Selects which events to delete; with no criteria every event matches.
+
+    time_min/time_max (RFC3339) are applied by the API and keep events that
+    overlap the range. key_prefixes match the "class_id,activity_id" tracking
+    key. orphans is an (upstream keys, covered class IDs) pair from
+    api_bot.upstream_keys; only events of removed activities then match.
+    """
+
+    def __init__(self, time_min=None, time_max=None, key_prefixes=(), orphans=None):
+        self.time_min = time_min
+        self.time_max = time_max
+        self.key_prefixes = tuple(key_prefixes)
+        self.orphans = orphans
+
+    def matches(self, event):
+        if self.key_prefixes:
+            key = get_tracking_key(event)
+            if not key or not key.startswith(self.key_prefixes):
+                return False
+        if self.orphans is not None and not is_orphan(event, *self.orphans):
+            return False
+        return True
+
+    def signature(self):
+        """Identifies the filter so a checkpoint is only resumed with the same criteria."""
+        orphans = sorted(self.orphans[0]) if self.orphans is not None else None
+        raw = json.dumps([self.time_min, self.time_max, self.key_prefixes, orphans], default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _checkpoint_path(calendar_id):
+    return os.path.join(STATE_DIR, f"removal_{safe_filename(calendar_id)}.json")
+
+def _load_checkpoint(calendar_id, signature):
+    try:
+        with open(_checkpoint_path(calendar_id), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("filter") != signature:
+        print("⚠️ Checkpoint was written with different filters, starting over")
+        return None
+    return data
+
+def _save_checkpoint(calendar_id, signature, page_token, summary):
+    write_json_atomic(_checkpoint_path(calendar_id), {
+        "filter": signature,
+        "page_token": page_token,
+        "ok": summary["ok"],
+        "failed": summary["failed"],
+        "updated": datetime.now(timezone.utc).isoformat(),
+    })
 
-    deleted = 0
+def _clear_checkpoint(calendar_id):
+    try:
+        os.remove(_checkpoint_path(calendar_id))
+    except FileNotFoundError:
+        pass
+
+# Delete up to BATCH_SIZE events in one batch request; google_calendar_service() is per thread
+def _delete_batch(calendar_id, events):
+    writer = CalendarBatchWriter(google_calendar_service(), calendar_id)
+    store = get_event_store(calendar_id)
     for event in events:
-        try:
-            service.events().delete(calendarId=calendar_id, eventId=event['id']).execute()
-            print(f"Deleted event: {event.get('summary', 'No Title')}")
-            deleted += 1
-        except Exception as e:
-            print(f"Failed to delete event {event.get('summary', 'No Title')}: {e}")
+        writer.delete(event['id'], label=event.get('summary', 'No Title'), on_success=lambda _, event_id=event['id']: store.forget(event_id))
+    return writer.flush()
+
+def _report(calendar_id, matched):
+    by_class = collections.Counter((get_tracking_key(e) or "untracked").split(",", 1)[0] for e in matched)
+    starts = sorted(e.get("start", {}).get("dateTime") or e.get("start", {}).get("date") or "" for e in matched)
+    print(f"🧪 Dry run: {len(matched)} events in '{calendar_id}' would be deleted")
+    if starts:
+        print(f"   Starting between {starts[0]} and {starts[-1]}")
+    for class_id, count in sorted(by_class.items()):
+        print(f"   class {class_id}: {count}")
+    for event in matched[:DRY_RUN_SAMPLE]:
+        print(f"   - {event.get('summary', 'No Title')} ({get_tracking_key(event) or event['id']})")
+    if len(matched) > DRY_RUN_SAMPLE:
+        print(f"   ... and {len(matched) - DRY_RUN_SAMPLE} more")
+    return {"dry_run": True, "matched": len(matched), "ok": 0, "failed": 0, "by_class": dict(by_class), "items": []}
+
+# Clear all (or all matching) events from a calendar
+def clear_calendar(calendar_id='primary', event_filter=None, dry_run=False, resume=False, workers=DELETE_CONCURRENCY):
+    """Delete the events matching event_filter, streaming pages and deleting in parallel batches.
+
+    Each page's matches go out as batch requests on a pool of `workers`
+    threads while the next page is listed. Progress is checkpointed after
+    every page; with resume=True an interrupted run continues where it
+    stopped. With dry_run=True nothing is deleted and a report is printed.
+    """
+    event_filter = event_filter or EventFilter()
+    service = google_calendar_service()
+    signature = event_filter.signature()
+    summary = {"dry_run": False, "matched": 0, "ok": 0, "failed": 0, "items": []}
+
+    checkpoint = _load_checkpoint(calendar_id, signature) if resume and not dry_run else None
+    page_token = None
+    if checkpoint:
+        page_token = checkpoint.get("page_token")
+        print(f"↩️ Resuming from checkpoint ({checkpoint['ok']} events already deleted)")
+
+    if dry_run:
+        matched = [
+            event
+            for page, _ in iter_event_pages(service, calendar_id, event_filter.time_min, event_filter.time_max)
+            for event in page if event_filter.matches(event)
+        ]
+        return _report(calendar_id, matched)
+
+    def collect(futures):
+        for future in futures:
+            result = future.result()
+            summary["ok"] += result["ok"]
+            summary["failed"] += result["failed"]
+            summary["items"].extend(result["items"])
+            for item in result["items"]:
+                if item["ok"]:
+                    print(f"Deleted event: {item['label']}")
+                else:
+                    print(f"Failed to delete event {item['label']}: {item['error']}")
+
+    with metrics.timed("clear_calendar"), ThreadPoolExecutor(max_workers=workers, thread_name_prefix="delete") as pool:
+        for _ in range(MAX_PASSES):
+            pass_matched = 0
+            pass_failed = summary["failed"]
+            in_flight = collections.deque()  # (page token after this page, futures)
+            for page, next_token in iter_event_pages(service, calendar_id, event_filter.time_min, event_filter.time_max, page_token):
+                matched = [event for event in page if event_filter.matches(event)]
+                pass_matched += len(matched)
+                futures = [
+                    pool.submit(_delete_batch, calendar_id, matched[i:i + BATCH_SIZE])
+                    for i in range(0, len(matched), BATCH_SIZE)
+                ]
+                in_flight.append((next_token, futures))
+                # Keep one page of deletes running while the next page is listed
+                while len(in_flight) > 1:
+                    token, done = in_flight.popleft()
+                    collect(done)
+                    _save_checkpoint(calendar_id, signature, token, summary)
+            while in_flight:
+                token, done = in_flight.popleft()
+                collect(done)
+                _save_checkpoint(calendar_id, signature, token, summary)
+
+            summary["matched"] += pass_matched
+            page_token = None
+            # Stop once a pass finds nothing left (or only events that keep failing)
+            if pass_matched == 0 or pass_matched == summary["failed"] - pass_failed:
+                break
+            print(f"🔁 {pass_matched} events matched this pass, listing again for stragglers")
+
+    _clear_checkpoint(calendar_id)
+    # Deleted events are already gone from the shared snapshot the bot reads
+    get_event_store(calendar_id).save()
+    print(f"✅ Finished. Successfully deleted {summary['ok']} events from calendar '{calendar_id}'.")
+    return summary
+
+def _rfc3339(value):
+    """Accept YYYY-MM-DD or a full ISO timestamp; naive values are taken as Bangkok time."""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=BANGKOK_TZ)
+    return parsed.isoformat()
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete events from a Google Calendar.")
+    parser.add_argument("--calendar", default=calendar_id, help="Calendar ID (default: GOOGLE_CALENDAR_ID)")
+    parser.add_argument("--from", dest="time_min", help="Only events ending after this date/time")
+    parser.add_argument("--to", dest="time_max", help="Only events starting before this date/time")
+    parser.add_argument("--class-id", action="append", default=[], help="Only events of this class (repeatable)")
+    parser.add_argument("--key-prefix", action="append", default=[], help="Only events whose tracking key starts with this")
+    parser.add_argument("--orphans", action="store_true", help="Only events whose activity no longer exists upstream")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be deleted without deleting")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from its checkpoint")
+    parser.add_argument("--workers", type=int, default=DELETE_CONCURRENCY, help="Batch requests in flight at once")
+    args = parser.parse_args()
+
+    orphans = None
+    if args.orphans:
+        tenant = tenant_for_calendar(args.calendar)
+        if tenant is None:
+            print(f"❌ No tenant syncs into calendar '{args.calendar}', cannot tell which events are orphaned")
+            return
+        orphans = upstream_keys(tenant)
+        if not orphans[1]:
+            print("❌ No activities could be fetched upstream, refusing to treat every event as orphaned")
+            return
 
-    print(f"✅ Finished. Successfully deleted {deleted} events from calendar '{calendar_id}'.")
+    event_filter = EventFilter(
+        time_min=_rfc3339(args.time_min),
+        time_max=_rfc3339(args.time_max),
+        key_prefixes=[f"{c}," for c in args.class_id] + args.key_prefix,
+        orphans=orphans,
+    )
+    clear_calendar(args.calendar or 'primary', event_filter, dry_run=args.dry_run, resume=args.resume, workers=max(1, args.workers))
 
 # Run it
 if __name__ == "__main__":
-    # Replace with your calendar ID or use 'primary'
-    clear_calendar(calendar_id)
+    main()
@@ -0,0 +1,81 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+
+class JobScheduler:
+    """Run named bot jobs without blocking the Discord event loop.
+
+    Blocking jobs run on a bounded thread pool. Starting a job while another
+    run with the same name is in flight attaches the caller to that run
+    instead of starting a duplicate; with a cooldown, a run that finished
+    successfully within the last `cooldown` seconds is reused as well.
+    Durations and failures are kept in `stats` per job name.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._running = {}
+        self._recent = {}  # name -> (finished at, result) of the last successful run
+        self.stats = {}
+
+    def is_running(self, name):
+        task = self._running.get(name)
+        return task is not None and not task.done()
+
+    async def run(self, name, func, *args, blocking=True, cooldown=0):
+        """Run func(*args) as job `name` and return its result.
+
+        With blocking=True func is a regular function run on the executor;
+        otherwise it is a coroutine function awaited on the event loop.
+        """
+        task = self._running.get(name)
+        recent = self._recent.get(name)
+        if task is not None and not task.done():
+            print(f"⏳ Job '{name}' is already running, waiting for its result")
+            metrics.inc("job_coalesced_total", job=name, reason="in_flight")
+        elif cooldown and recent is not None and time.monotonic() - recent[0] < cooldown:
+            print(f"♻️ Job '{name}' finished {time.monotonic() - recent[0]:.0f}s ago, reusing its result")
+            metrics.inc("job_coalesced_total", job=name, reason="cooldown")
+            return recent[1]
+        else:
+            task = asyncio.ensure_future(self._execute(name, func, args, blocking))
+            self._running[name] = task
+            task.add_done_callback(functools.partial(self._forget, name))
+        # Shield so a cancelled caller doesn't cancel the run others are waiting on
+        return await asyncio.shield(task)
+
+    def _forget(self, name, task):
+        if self._running.get(name) is task:
+            del self._running[name]
+
+    async def _execute(self, name, func, args, blocking):
+        stats = self.stats.setdefault(name, {"runs": 0, "failures": 0, "last_duration": None, "last_finished": None, "last_error": None})
+        start = time.monotonic()
+        print(f"▶️ Job '{name}' started")
+        try:
+            if blocking:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self._executor, functools.partial(func, *args))
+            else:
+                result = await func(*args)
+        except Exception as e:
+            stats["failures"] += 1
+            metrics.inc("job_failures_total", job=name)
+            stats["last_error"] = str(e)
+            raise
+        finally:
+            duration = time.monotonic() - start
+            stats["runs"] += 1
+            stats["last_duration"] = duration
+            stats["last_finished"] = time.time()
+            metrics.observe("job_duration_seconds", duration, job=name)
+            print(f"⏱️ Job '{name}' finished in {duration:.1f}s")
+        stats["last_error"] = None
+        self._recent[name] = (time.monotonic(), result)
+        return result
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
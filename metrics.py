@@ -0,0 +1,199 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# METRICS_PORT and JSON_LOGS are read when used, not at import: this module is
+# imported before the entry points call load_dotenv()
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_help = {}
+_collectors = []  # Callables returning (name, labels, value) gauge samples at scrape time
+_server = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def describe(name, text):
+    _help[name] = text
+
+
+def inc(name, amount=1, **labels):
+    """Add amount to counter `name` with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """Record value in histogram `name` with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        data = _histograms.get(key)
+        if data is None:
+            data = _histograms[key] = [0] * (len(DEFAULT_BUCKETS) + 2)
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+
+def register_gauges(collector):
+    """Have collector() supply gauge samples, as (name, {labels}, value) tuples, on every scrape."""
+    _collectors.append(collector)
+
+
+def log_json(event, **fields):
+    """Write a structured log line to stdout when JSON_LOGS is enabled."""
+    if os.getenv("JSON_LOGS", "false").lower() != "true":
+        return
+    record = {"ts": round(time.time(), 3), "event": event}
+    record.update(fields)
+    sys.stdout.write(json.dumps(record, default=str) + "\n")
+    sys.stdout.flush()
+
+
+@contextlib.contextmanager
+def timed(stage, budget=None, **labels):
+    """Time a block as stage_duration_seconds{stage=...}.
+
+    If budget (seconds) is given and exceeded, a warning is printed and
+    stage_budget_exceeded_total is incremented.
+    """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        observe("stage_duration_seconds", duration, stage=stage, **labels)
+        if status == "error":
+            inc("stage_errors_total", stage=stage, **labels)
+        log_json("stage", stage=stage, status=status, duration_seconds=round(duration, 4), **labels)
+        if budget is not None and duration > budget:
+            inc("stage_budget_exceeded_total", stage=stage, **labels)
+            print(f"⚠️ Stage '{stage}' took {duration:.1f}s, over its {budget:.0f}s budget")
+
+
+def api_call(api, op, amount=1):
+    inc("api_calls_total", amount, api=api, op=op)
+
+
+def rate_limited(api):
+    inc("rate_limited_total", api=api)
+
+
+def retried(api):
+    inc("retries_total", api=api)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render_prometheus():
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    gauges = {}
+    for collector in list(_collectors):
+        try:
+            for name, labels, value in collector():
+                if value is not None:
+                    gauges[_key(name, labels)] = value
+        except Exception as e:
+            print(f"⚠️ Gauge collector {getattr(collector, '__name__', collector)} failed: {e}")
+
+    seen = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            seen.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), value in sorted(gauges.items()):
+        if name not in seen:
+            seen.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), data in sorted(histograms.items()):
+        if name not in seen:
+            seen.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+        for bound, count in zip(DEFAULT_BUCKETS, data):
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {data[-1]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {round(data[-2], 6)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {data[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body = render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        elif self.path.startswith("/healthz"):
+            body = b"ok\n"
+            content_type = "text/plain"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=None, host="0.0.0.0"):
+    """Serve /metrics and /healthz on a daemon thread. No-op when the port is 0."""
+    global _server
+    if port is None:
+        port = int(os.getenv("METRICS_PORT", "0") or 0)  # 0 = no metrics endpoint
+    if not port or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, daemon=True, name="metrics").start()
+    print(f"📈 Metrics endpoint listening on :{port}/metrics")
+    return _server
+
+
+describe("api_calls_total", "Outbound API calls by API and operation.")
+describe("rate_limited_total", "Responses or waits caused by rate limiting.")
+describe("retries_total", "Outbound requests retried after a failure.")
+describe("stage_duration_seconds", "Duration of sync and notify stages.")
+describe("stage_errors_total", "Stages that ended with an exception.")
+describe("stage_budget_exceeded_total", "Stages that ran longer than their time budget.")
@@ -0,0 +1,55 @@
+import datetime
+import os
+
+POLL_INTERVAL_MINUTES = float(os.getenv("POLL_INTERVAL_MINUTES", "0") or 0)  # Normal poll interval (0 = no polling)
+POLL_MIN_MINUTES = float(os.getenv("POLL_MIN_MINUTES", "10") or 10)  # Interval while homework is due soon
+POLL_MAX_MINUTES = float(os.getenv("POLL_MAX_MINUTES", "180") or 180)  # Longest wait, used during quiet hours
+POLL_URGENT_HOURS = float(os.getenv("POLL_URGENT_HOURS", "24") or 24)  # "Due soon" means due within this many hours
+POLL_QUIET_HOURS_RAW = os.getenv("POLL_QUIET_HOURS", "23-7")  # Bangkok hours with slow polling, "start-end"
+
+
+def _parse_quiet_hours(raw):
+    try:
+        start, end = (int(part) % 24 for part in raw.split("-", 1))
+        return start, end
+    except (AttributeError, ValueError):
+        return None
+
+
+POLL_QUIET_HOURS = _parse_quiet_hours(POLL_QUIET_HOURS_RAW)
+
+
+def polling_enabled():
+    return POLL_INTERVAL_MINUTES > 0
+
+
+def _quiet_until(now_bkk):
+    """End of the current quiet period, or None if now_bkk is outside quiet hours."""
+    if not POLL_QUIET_HOURS:
+        return None
+    start, end = POLL_QUIET_HOURS
+    hour = now_bkk.hour
+    quiet = start <= hour < end if start <= end else hour >= start or hour < end
+    if not quiet:
+        return None
+    until = now_bkk.replace(hour=end, minute=0, second=0, microsecond=0)
+    if until <= now_bkk:
+        until += datetime.timedelta(days=1)
+    return until
+
+
+def next_poll_delay(now_bkk, next_due_bkk=None):
+    """Seconds to wait before the next poll.
+
+    Quiet hours wait up to POLL_MAX_MINUTES (but not past the end of the quiet
+    period), homework due within POLL_URGENT_HOURS polls every
+    POLL_MIN_MINUTES, otherwise POLL_INTERVAL_MINUTES.
+    """
+    low = POLL_MIN_MINUTES * 60
+    high = max(low, POLL_MAX_MINUTES * 60)
+    quiet_until = _quiet_until(now_bkk)
+    if quiet_until is not None:
+        return max(low, min(high, (quiet_until - now_bkk).total_seconds()))
+    if next_due_bkk is not None and (next_due_bkk - now_bkk).total_seconds() <= POLL_URGENT_HOURS * 3600:
+        return low
+    return max(low, min(high, POLL_INTERVAL_MINUTES * 60))
@@ -0,0 +1,137 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import os
+import re
+
+import metrics
+
+REMINDER_OFFSETS_RAW = os.getenv("REMINDER_OFFSETS", "")  # e.g. "24h,3h,1h"; empty = no reminders
+_OFFSET_UNITS = {"d": 86400, "h": 3600, "m": 60}
+
+
+def parse_offsets(raw):
+    """Parse "24h,3h,30m" into timedeltas, largest first. Invalid entries are skipped."""
+    offsets = set()
+    for part in (raw or "").split(","):
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([dhm])\s*", part)
+        if not match:
+            if part.strip():
+                print(f"❌ Invalid reminder offset '{part.strip()}', expected e.g. 24h, 90m or 2d")
+            continue
+        offsets.add(datetime.timedelta(seconds=float(match.group(1)) * _OFFSET_UNITS[match.group(2)]))
+    return sorted(offsets, reverse=True)
+
+
+def format_offset(offset):
+    seconds = int(offset.total_seconds())
+    for unit, size in _OFFSET_UNITS.items():
+        if seconds >= size and seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+
+REMINDER_OFFSETS = parse_offsets(REMINDER_OFFSETS_RAW)
+
+
+class ReminderScheduler:
+    """Fire pre-deadline reminders from a single task sleeping until the next one is due.
+
+    Pending reminders live in a min-heap of (fire_at, seq, key, version, offset).
+    update_calendar() bumps an event's version when its due time changes
+    instead of searching the heap; outdated entries are dropped when they
+    reach the top. send(channel_id, [(item, offset), ...]) is awaited with all
+    of a channel's reminders that are due together.
+    """
+
+    def __init__(self, offsets, send):
+        self.offsets = list(offsets)
+        self._send = send
+        self._heap = []
+        self._events = {}       # (calendar_id, event_id) -> [version, end, channel_id, item]
+        self._by_calendar = {}  # calendar_id -> {event_id}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def update_calendar(self, calendar_id, channel_id, items, now):
+        """Replace calendar_id's upcoming events with items (objects with event_id and end_bkk)."""
+        earliest = self._heap[0][0] if self._heap else None
+        seen = set()
+        for item in items:
+            end = item.end_bkk
+            if end is None:
+                continue
+            key = (calendar_id, item.event_id)
+            seen.add(item.event_id)
+            entry = self._events.get(key)
+            if entry is not None and entry[1] == end and entry[2] == channel_id:
+                entry[3] = item  # Keep the newest title/link
+                continue
+            # Versions come from the shared counter so an event that was dropped and
+            # comes back never matches heap entries left over from before
+            version = next(self._seq)
+            self._events[key] = [version, end, channel_id, item]
+            for offset in self.offsets:
+                fire_at = end - offset
+                if fire_at > now:
+                    heapq.heappush(self._heap, (fire_at, next(self._seq), key, version, offset))
+
+        for event_id in self._by_calendar.get(calendar_id, set()) - seen:
+            self._events.pop((calendar_id, event_id), None)
+        self._by_calendar[calendar_id] = seen
+
+        self._compact()
+        if self._heap and (earliest is None or self._heap[0][0] < earliest):
+            self._wakeup.set()
+
+    def _is_current(self, entry):
+        _, _, key, version, _ = entry
+        event = self._events.get(key)
+        return event is not None and event[0] == version
+
+    def _compact(self):
+        # Rebuild once outdated entries dominate so the heap stays proportional to live reminders
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._events) * max(1, len(self.offsets)):
+            self._heap = [entry for entry in self._heap if self._is_current(entry)]
+            heapq.heapify(self._heap)
+
+    def _next_fire_at(self):
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now):
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if not self._is_current(entry):
+                continue
+            _, _, key, _, offset = entry
+            _, _, channel_id, item = self._events[key]
+            due.setdefault(channel_id, []).append((item, offset))
+        return due
+
+    async def run(self):
+        """Sleep until the earliest reminder (or an earlier one being added), then send what is due."""
+        while True:
+            self._wakeup.clear()
+            fire_at = self._next_fire_at()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if fire_at is None or fire_at > now:
+                timeout = None if fire_at is None else (fire_at - now).total_seconds()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for channel_id, reminders in self._pop_due(now).items():
+                try:
+                    await self._send(channel_id, reminders)
+                    metrics.inc("reminders_sent_total", len(reminders))
+                except Exception as e:
+                    print(f"❌ Failed to send {len(reminders)} reminder(s) to channel {channel_id}: {e}")
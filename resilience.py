@@ -0,0 +1,214 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import metrics
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Settings are read when used, not at import: this module is imported before
+# the entry points call load_dotenv()
+def _setting(name, default):
+    return float(os.getenv(name, "") or default)
+
+
+def retry_max_attempts():
+    return max(1, int(_setting("RETRY_MAX_ATTEMPTS", 5)))
+
+
+def retry_base_delay():
+    return _setting("RETRY_BASE_DELAY", 1)  # Seconds before the first retry
+
+
+def retry_max_delay():
+    return _setting("RETRY_MAX_DELAY", 60)
+
+
+class RetryableError(Exception):
+    """Raised by callers for a response that should be retried (e.g. a 429/5xx status)."""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = _parse_retry_after(retry_after)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling out when a host's circuit breaker is open."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a retry would run past the current run's deadline."""
+
+
+class Deadline:
+    """Wall-clock budget for one run; seconds=None or 0 means no deadline."""
+
+    def __init__(self, seconds=None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures so a down host is not hammered.
+
+    While open, calls fail fast with CircuitOpenError. After reset_seconds one
+    trial call is let through (half-open); success closes the circuit again.
+    """
+
+    def __init__(self, host, failure_threshold=None, reset_seconds=None):
+        self.host = host
+        self.failure_threshold = failure_threshold or max(1, int(_setting("CIRCUIT_FAILURE_THRESHOLD", 5)))
+        self.reset_seconds = reset_seconds or _setting("CIRCUIT_RESET_SECONDS", 60)
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                # Half-open: let one call probe the host
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold and self._opened_at is None:
+                self._opened_at = time.monotonic()
+                metrics.inc("circuit_opened_total", host=self.host)
+                print(f"🚧 Circuit opened for {self.host} after {self._failures} consecutive failures")
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+def _parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(exc):
+    """Return (retryable, status, retry_after_seconds) for an exception."""
+    if isinstance(exc, RetryableError):
+        return True, exc.status, exc.retry_after
+    # googleapiclient HttpError: status and headers on exc.resp
+    resp = getattr(exc, "resp", None)
+    if resp is not None and getattr(resp, "status", None) is not None:
+        status = int(resp.status)
+        retry_after = _parse_retry_after(resp.get("retry-after")) if hasattr(resp, "get") else None
+        rate_limited = status == 403 and b"rateLimitExceeded" in (getattr(exc, "content", b"") or b"")
+        return status in RETRYABLE_STATUSES or rate_limited, status, retry_after
+    # discord.HTTPException: status on exc.status, headers on exc.response
+    status = getattr(exc, "status", None)
+    if isinstance(status, int):
+        headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+        return status in RETRYABLE_STATUSES, status, _parse_retry_after(headers.get("Retry-After"))
+    # Connection resets, timeouts and DNS failures (requests/aiohttp errors are OSErrors too)
+    if isinstance(exc, (OSError, TimeoutError, asyncio.TimeoutError)):
+        return True, None, None
+    return False, None, None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+    max_delay = retry_max_delay()
+    delay = random.uniform(0, min(max_delay, retry_base_delay() * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_delay))
+    return delay
+
+
+def _before_attempt(breaker, deadline):
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded(f"Run deadline reached before calling {breaker.host}")
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit open for {breaker.host}")
+
+
+def _after_failure(exc, attempt, breaker, api, deadline, throttle, max_attempts):
+    """Record a failed attempt; return the delay before retrying, or re-raise."""
+    retryable, status, retry_after = classify(exc)
+    if not retryable:
+        raise exc
+    breaker.record_failure()
+    if status == 429:
+        metrics.rate_limited(api)
+        if throttle is not None:
+            throttle.on_throttled()
+    if attempt + 1 >= max_attempts:
+        raise exc
+    delay = backoff_delay(attempt, retry_after)
+    remaining = deadline.remaining() if deadline is not None else None
+    if remaining is not None and delay >= remaining:
+        raise DeadlineExceeded(f"Not retrying {api}: next attempt would pass the run deadline") from exc
+    metrics.retried(api)
+    print(f"🔁 {api} call failed ({status or type(exc).__name__}), retrying in {delay:.1f}s")
+    return delay
+
+
+def call_with_retry(func, host, api, deadline=None, throttle=None, max_attempts=None):
+    """Call func() with backoff on 429/5xx/connection errors.
+
+    host selects the circuit breaker, api labels metrics. throttle, if given,
+    is told about 429s (on_throttled) and successes (on_success).
+    """
+    breaker = get_breaker(host)
+    max_attempts = max_attempts or retry_max_attempts()
+    for attempt in range(max_attempts):
+        _before_attempt(breaker, deadline)
+        try:
+            result = func()
+        except Exception as exc:
+            time.sleep(_after_failure(exc, attempt, breaker, api, deadline, throttle, max_attempts))
+            continue
+        breaker.record_success()
+        if throttle is not None:
+            throttle.on_success()
+        return result
+
+
+async def async_call_with_retry(coro_factory, host, api, deadline=None, throttle=None, max_attempts=None):
+    """Async variant of call_with_retry; coro_factory() must return a new awaitable each time."""
+    breaker = get_breaker(host)
+    max_attempts = max_attempts or retry_max_attempts()
+    for attempt in range(max_attempts):
+        _before_attempt(breaker, deadline)
+        try:
+            result = await coro_factory()
+        except Exception as exc:
+            await asyncio.sleep(_after_failure(exc, attempt, breaker, api, deadline, throttle, max_attempts))
+            continue
+        breaker.record_success()
+        if throttle is not None:
+            throttle.on_success()
+        return result
@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Set before the bot modules are imported: they read these at import time
+os.environ["STATE_DIR"] = tempfile.mkdtemp(prefix="test-state-")
+os.environ.setdefault("RETRY_BASE_DELAY", "0.01")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    """Give each test its own STATE_DIR and empty process-wide stores."""
+    import activity_store
+    import api_bot
+    import calendar_store
+
+    for module in (api_bot, activity_store, calendar_store):
+        monkeypatch.setattr(module, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(calendar_store, "_stores", {})
+    monkeypatch.setattr(activity_store, "_stores", {})
+    return tmp_path
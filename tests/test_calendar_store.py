@@ -0,0 +1,80 @@
+import calendar_store
+import fakes
+
+
+class ExpiringTokenCalendar(fakes.FakeCalendarService):
+    """Answers the next syncToken listing with 410 Gone, like an expired token."""
+
+    expire_next = False
+
+    def list_page(self, page_token, max_results, sync_token, time_min):
+        if sync_token is not None and self.expire_next:
+            self.expire_next = False
+            raise fakes._http_error(410)
+        return super().list_page(page_token, max_results, sync_token, time_min)
+
+
+def _seed(calendar, count):
+    calendar.seed_events(
+        fakes.make_calendar_event(1, i, "2030-01-01T00:00:00+07:00", "2030-01-01T01:00:00+07:00")
+        for i in range(count)
+    )
+
+
+def test_expired_sync_token_falls_back_to_full_resync(state_dir):
+    calendar = ExpiringTokenCalendar()
+    _seed(calendar, 3)
+    store = calendar_store.CalendarEventStore("cal")
+    assert store.sync(calendar) == 3
+
+    # Deleted while the token was unusable: only a full listing drops it
+    gone = next(iter(calendar.events_by_id))
+    calendar.remove(gone)
+    calendar.expire_next = True
+
+    assert store.sync(calendar) == 2
+    assert gone not in store.events
+    assert len(store.events) == 2
+    assert store.sync_token is not None
+
+    reloaded = calendar_store.CalendarEventStore("cal")
+    assert set(reloaded.events) == set(store.events)
+    assert reloaded.sync_token == store.sync_token
+
+
+def test_unchanged_delta_sync_does_not_rewrite_the_file(state_dir, monkeypatch):
+    calendar = fakes.FakeCalendarService()
+    _seed(calendar, 2)
+    store = calendar_store.CalendarEventStore("cal")
+    store.sync(calendar)
+
+    writes = []
+    monkeypatch.setattr(calendar_store, "write_json_atomic", lambda path, data: writes.append(path))
+    assert store.sync(calendar) == 0
+    store.save()
+    assert writes == []
+
+    store.forget(next(iter(store.events)))
+    store.save()
+    assert len(writes) == 1
+
+
+class FlakyListCalendar(fakes.FakeCalendarService):
+    """Fails the first listing with a transient 503."""
+
+    failures = 1
+
+    def list_page(self, page_token, max_results, sync_token, time_min):
+        if self.failures:
+            self.failures -= 1
+            raise fakes._http_error(503)
+        return super().list_page(page_token, max_results, sync_token, time_min)
+
+
+def test_transient_list_error_is_retried(state_dir):
+    calendar = FlakyListCalendar()
+    _seed(calendar, 2)
+    store = calendar_store.CalendarEventStore("cal")
+
+    assert store.sync(calendar) == 2
+    assert calendar.calls.snapshot()["events.list"] == 2
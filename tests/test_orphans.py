@@ -0,0 +1,102 @@
+import datetime
+
+import pytest
+
+import api_bot
+import calendar_store
+import fakes
+
+
+def _event(class_id, activity_id, end=None):
+    end = end or (datetime.datetime.now(api_bot.BANGKOK_TZ) + datetime.timedelta(days=1)).isoformat()
+    return fakes.make_calendar_event(class_id, activity_id, end, end)
+
+
+def _bangkok_end(delta):
+    return (datetime.datetime.now(api_bot.BANGKOK_TZ) + delta).isoformat()
+
+
+def test_classes_without_activities_are_not_covered():
+    keys, covered = api_bot.upstream_keys(None, {1: [{"id": 5}], 2: [], 3: None})
+
+    assert keys == {"1,5"}
+    assert covered == {1}
+    assert not api_bot.is_orphan(_event(2, 7), keys, covered)
+    assert not api_bot.is_orphan(_event(3, 7), keys, covered)
+    assert api_bot.is_orphan(_event(1, 7), keys, covered)
+    assert not api_bot.is_orphan(_event(1, 5), keys, covered)
+
+
+def test_hand_made_events_are_left_alone():
+    keys, covered = {"1,5"}, {1}
+    untracked = {"summary": "Dentist", "end": {"dateTime": _bangkok_end(datetime.timedelta(days=1))}}
+    described = dict(untracked, description="Bring homework 1")
+    odd_key = _event(1, 7)
+    odd_key["extendedProperties"]["private"]["tracking_key"] = "1,7,extra"
+
+    assert not api_bot.is_orphan(untracked, keys, covered)
+    assert not api_bot.is_orphan(described, keys, covered)
+    assert not api_bot.is_orphan(odd_key, keys, covered)
+
+
+def test_windowed_mode_keeps_events_before_the_fetch_window(monkeypatch):
+    monkeypatch.setattr(api_bot, "FETCH_MODE", "windowed")
+    monkeypatch.setattr(api_bot, "FETCH_WINDOW_DAYS", 30)
+    keys, covered = set(), {1}
+    margin = datetime.timedelta(minutes=5)
+
+    before = _event(1, 1, _bangkok_end(-datetime.timedelta(days=30) - margin))
+    inside = _event(1, 2, _bangkok_end(-datetime.timedelta(days=30) + margin))
+
+    assert not api_bot.is_orphan(before, keys, covered)
+    assert api_bot.is_orphan(inside, keys, covered)
+
+    monkeypatch.setattr(api_bot, "FETCH_MODE", "full")
+    assert api_bot.is_orphan(before, keys, covered)
+
+
+def test_orphan_is_tagged_then_untagged_when_it_reappears(state_dir, monkeypatch):
+    monkeypatch.setattr(api_bot, "ORPHAN_MODE", "tag")
+    calendar = fakes.FakeCalendarService()
+    monkeypatch.setattr(api_bot, "google_calendar_service", lambda: calendar)
+    activities = fakes.make_activities(1, 3)
+
+    def summaries():
+        return sorted(e["summary"] for e in calendar.events_by_id.values() if e["status"] != "cancelled")
+
+    with fakes.FakeActivitiesServer({1: activities}) as server:
+        tenant = api_bot.Tenant("t", "1", {}, {1: "Math"}, server.url, "cal")
+        api_bot.sync_tenant(tenant)
+        removed = activities.pop(1)
+        api_bot.sync_tenant(tenant)
+
+        assert summaries() == ["Math - Activity 1", "Math - Activity 3", "[Removed] Math - Activity 2"]
+        store = calendar_store.get_event_store("cal")
+        assert [e["summary"] for e in store.upcoming(datetime.datetime.now(datetime.timezone.utc))].count("[Removed] Math - Activity 2") == 0
+
+        activities.insert(1, removed)
+        api_bot.sync_tenant(tenant)
+
+    assert summaries() == ["Math - Activity 1", "Math - Activity 2", "Math - Activity 3"]
+    restored = next(e for e in calendar.events_by_id.values() if e["summary"] == "Math - Activity 2")
+    assert calendar_store.ORPHAN_PROPERTY not in restored["extendedProperties"]["private"]
+
+
+def test_off_mode_leaves_orphans(state_dir, monkeypatch):
+    monkeypatch.setattr(api_bot, "ORPHAN_MODE", "off")
+    writer = api_bot.CalendarBatchWriter(fakes.FakeCalendarService(), "cal")
+    index = {"1,7": dict(_event(1, 7), id="evt1")}
+
+    assert api_bot.reconcile_orphans(index, {"1,5"}, {1}, writer) == 0
+    assert not writer._pending
+
+
+@pytest.mark.parametrize("mode", ["delete", "tag"])
+def test_failed_class_fetch_protects_its_events(state_dir, monkeypatch, mode):
+    monkeypatch.setattr(api_bot, "ORPHAN_MODE", mode)
+    writer = api_bot.CalendarBatchWriter(fakes.FakeCalendarService(), "cal")
+    index = {"2,7": dict(_event(2, 7), id="evt1")}
+    keys, covered = api_bot.upstream_keys(None, {1: [{"id": 5}], 2: []})
+
+    assert api_bot.reconcile_orphans(index, keys, covered, writer) == 0
+    assert not writer._pending
@@ -0,0 +1,52 @@
+import datetime
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reminders import ReminderScheduler, parse_offsets  # noqa: E402
+
+NOW = datetime.datetime(2026, 1, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+def _item(event_id, due):
+    return types.SimpleNamespace(event_id=event_id, end_bkk=due)
+
+
+def _due(scheduler, at):
+    return {channel: [(item.event_id, offset) for item, offset in reminders]
+            for channel, reminders in scheduler._pop_due(at).items()}
+
+
+def test_readded_event_is_reminded_once():
+    scheduler = ReminderScheduler(parse_offsets("1h"), send=None)
+    due = NOW + datetime.timedelta(hours=3)
+    scheduler.update_calendar("cal", 1, [_item("e1", due)], NOW)
+    scheduler.update_calendar("cal", 1, [], NOW)
+    scheduler.update_calendar("cal", 1, [_item("e1", due)], NOW)
+
+    assert _due(scheduler, due) == {1: [("e1", datetime.timedelta(hours=1))]}
+
+
+def test_readded_event_uses_new_due_time():
+    scheduler = ReminderScheduler(parse_offsets("1h"), send=None)
+    old_due = NOW + datetime.timedelta(hours=3)
+    new_due = NOW + datetime.timedelta(hours=6)
+    scheduler.update_calendar("cal", 1, [_item("e1", old_due)], NOW)
+    scheduler.update_calendar("cal", 1, [], NOW)
+    scheduler.update_calendar("cal", 1, [_item("e1", new_due)], NOW)
+
+    assert _due(scheduler, old_due) == {}
+    assert _due(scheduler, new_due) == {1: [("e1", datetime.timedelta(hours=1))]}
+
+
+def test_rescheduled_event_drops_old_reminders():
+    scheduler = ReminderScheduler(parse_offsets("2h,1h"), send=None)
+    old_due = NOW + datetime.timedelta(hours=3)
+    new_due = NOW + datetime.timedelta(hours=10)
+    scheduler.update_calendar("cal", 1, [_item("e1", old_due)], NOW)
+    scheduler.update_calendar("cal", 1, [_item("e1", new_due)], NOW)
+
+    assert _due(scheduler, old_due) == {}
+    assert _due(scheduler, new_due) == {1: [("e1", datetime.timedelta(hours=2)), ("e1", datetime.timedelta(hours=1))]}